@@ -1,30 +1,60 @@
 import os
 from dotenv import load_dotenv
 import json
-from tavily import TavilyClient
 import base64
-from PIL import Image
+import collections
 import io
 import re
-from anthropic import Anthropic, APIStatusError, APIError
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient, APIStatusError, APIError
+import httpx
+import importlib.util
 import difflib
+import hashlib
+import functools
+import itertools
 import time
-from rich.console import Console
+from rich.console import Console, Group
 from rich.panel import Panel
+from rich.table import Table
+from rich.box import ROUNDED
 from rich.syntax import Syntax
-from rich.markdown import Markdown
+from rich.text import Text
 import asyncio
 from prompt_toolkit import PromptSession
 from prompt_toolkit.styles import Style
-import difflib
 from prompt_toolkit.completion import WordCompleter
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn
 import datetime
 import venv
+from pathlib import Path
 import sys
 import signal
 import logging
-from typing import Tuple, Optional
+import locale
+import mmap
+import stat
+from typing import Tuple, Optional, Dict, Any
+from dataclasses import dataclass
+
+try:
+    # orjson的序列化/解析速度远快于标准库json，未安装时回退到json
+    # orjson.JSONDecodeError是json.JSONDecodeError的子类，调用方统一捕获后者即可
+    import orjson
+
+    def jdumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode()
+
+    jloads = orjson.loads
+except ImportError:
+    def jdumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
+
+    jloads = json.loads
+
+try:
+    # uvloop基于libuv，替换默认的事件循环以降低协程调度和子进程创建的开销（Windows不支持）
+    import uvloop
+except ImportError:
+    uvloop = None
 
 '''
 1. main() 是最顶层函数,控制整体流程。
@@ -87,9 +117,15 @@ async def get_format_choice():
     # 返回用户选择的格式，转换为小写
     return result.lower()
 
+# 虚拟环境中可执行文件的目录和文件名，平台在进程生命周期内不变
+_VENV_BIN = "Scripts" if sys.platform == "win32" else "bin"
+_ACTIVATE_NAME = "activate.bat" if sys.platform == "win32" else "activate"
+_PYTHON_NAME = "python.exe" if sys.platform == "win32" else "python"
+
+@functools.lru_cache(maxsize=1)
 def setup_virtual_environment() -> Tuple[str, str]:
     """
-    设置虚拟环境的函数。
+    设置虚拟环境的函数。结果在进程内缓存，虚拟环境只在第一次调用时检查和创建。
     
     返回:
     Tuple[str, str]: 返回虚拟环境的路径和激活脚本的路径。
@@ -110,10 +146,7 @@ def setup_virtual_environment() -> Tuple[str, str]:
             venv.create(venv_path, with_pip=True)
         
         # 激活虚拟环境的脚本路径
-        if sys.platform == "win32":
-            activate_script = os.path.join(venv_path, "Scripts", "activate.bat")
-        else:
-            activate_script = os.path.join(venv_path, "bin", "activate")
+        activate_script = os.path.join(venv_path, _VENV_BIN, _ACTIVATE_NAME)
         
         # 返回虚拟环境路径和激活脚本路径
         return venv_path, activate_script
@@ -131,39 +164,346 @@ if not anthropic_api_key:
     # 如果没有找到API密钥，则抛出错误
     raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
 anthropic_base_url = os.getenv("ANTHROPIC_BASE_URL")
-if not anthropic_base_url:
-    # 初始化Anthropic客户端
-    client = Anthropic(api_key=anthropic_api_key, base_url=anthropic_base_url)
-else:
-    client = Anthropic(api_key=anthropic_api_key)
+# 整个进程共用一个异步客户端和连接池，保持连接存活以避免每次调用重新进行TLS握手；安装了h2时启用HTTP/2多路复用
+client = AsyncAnthropic(
+    api_key=anthropic_api_key,
+    base_url=anthropic_base_url,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        http2=importlib.util.find_spec("h2") is not None,
+    ),
+)
 
 # 初始化Tavily客户端
 tavily_api_key = os.getenv("TAVILY_API_KEY")
 if not tavily_api_key:
     # 如果没有找到Tavily API密钥，则抛出错误
     raise ValueError("TAVILY_API_KEY not found in environment variables")
-tavily = TavilyClient(api_key=tavily_api_key)
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+# Tavily的HTTP客户端在第一次搜索时才创建，之后复用其keep-alive连接池，避免每次搜索都重新建立TCP+TLS连接
+_tavily_http = None
+
+def get_tavily_http():
+    """
+    获取访问Tavily API的异步HTTP客户端，第一次调用时创建。
+
+    返回:
+    httpx.AsyncClient: 复用连接的HTTP客户端对象。
+    """
+    global _tavily_http
+    if _tavily_http is None:
+        _tavily_http = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {tavily_api_key}"},
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=32, keepalive_expiry=60),
+            timeout=httpx.Timeout(60.0),
+        )
+    return _tavily_http
+
+class TokenBucket:
+    """
+    按每分钟请求数和每分钟输入token数限速的令牌桶，在发送请求前主动等待，避免触发429后再退避重试。
+    两个额度都按时间连续恢复，额度为0表示不限制。
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = float(rpm)
+        self.available_tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens=0):
+        """
+        等待直到有足够的额度发送一次请求，并扣除额度。
+
+        参数:
+        tokens (int): 该请求预计的输入token数。
+        """
+        if not self.rpm and not self.tpm:
+            return
+        tokens = min(tokens, self.tpm)  # 超过每分钟额度的请求最多等待额度恢复满
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self.available_requests < 1:
+                    wait = max(wait, (1 - self.available_requests) * 60 / self.rpm)
+                if self.tpm and self.available_tokens < tokens:
+                    wait = max(wait, (tokens - self.available_tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self.available_requests -= 1
+            if self.tpm:
+                self.available_tokens -= tokens
+
+# Anthropic API的限速器，限额通过环境变量ANTHROPIC_RPM和ANTHROPIC_INPUT_TPM设置，未设置时不限速
+rate_limiter = TokenBucket(rpm=int(os.getenv("ANTHROPIC_RPM", "0")), tpm=int(os.getenv("ANTHROPIC_INPUT_TPM", "0")))
+
+# 本地估计token数时的切分规则：英文单词、最多3位的数字、其他每个非空白字符（包括每个汉字）各算一个token
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d{1,3}|\S")
+
+# 图像的估计token数：encode_image_to_base64()将图像缩小到不超过1024x1024，约为宽x高/750
+IMAGE_TOKENS = 1024 * 1024 // 750
+
+def count_tokens(text):
+    """
+    在本地估计文本的token数。不按文本缓存结果：系统提示的token数保存在_system_prompt_cache中，
+    历史消息的token数保存在BoundedHistory.tokens中。
+
+    参数:
+    text (str): 文本。
+
+    返回:
+    int: 估计的token数。
+    """
+    return len(_TOKEN_RE.findall(text))
+
+def message_tokens(message):
+    """
+    估计一条对话消息的token数。
+
+    参数:
+    message (dict): 对话消息。
+
+    返回:
+    int: 估计的token数。
+    """
+    return content_tokens(message["content"])
+
+def content_tokens(content):
+    """
+    估计消息内容的token数。图像按IMAGE_TOKENS计算，不计算其base64数据。
+
+    参数:
+    content (Union[str, list]): 消息内容或内容块列表。
+
+    返回:
+    int: 估计的token数。
+    """
+    if isinstance(content, str):
+        return count_tokens(content)
+    tokens = 0
+    for block in content:
+        block_type = block.get("type")
+        if block_type == "text":
+            tokens += count_tokens(block["text"])
+        elif block_type == "image":
+            tokens += IMAGE_TOKENS
+        elif block_type == "tool_result":
+            tokens += content_tokens(block.get("content", ""))
+        else:
+            tokens += count_tokens(jdumps(block))
+    return tokens
+
+def request_tokens(system_tokens, messages):
+    """
+    估计一次请求的输入token数（系统提示、工具定义和消息），用于限速和上下文预算。
+
+    参数:
+    system_tokens (int): 系统提示的估计token数。
+    messages (list): 要发送的消息列表。
+
+    返回:
+    int: 估计的token数。
+    """
+    return system_tokens + TOOLS_JSON_TOKENS + sum(message_tokens(message) for message in messages)
 
 # 创建控制台对象
 console = Console()
 
+# 单个模型的token使用统计
+@dataclass(slots=True)
+class TokenStats:
+    input: int = 0
+    output: int = 0
+    cache_creation: int = 0
+    cache_read: int = 0
+    cost: float = 0.0
+
+    def add(self, input_tokens, output_tokens, cache_creation, cache_read, cost):
+        self.input += input_tokens
+        self.output += output_tokens
+        self.cache_creation += cache_creation
+        self.cache_read += cache_read
+        self.cost += cost
+
 # token跟踪变量
-main_model_tokens = {'input': 0, 'output': 0}
-tool_checker_tokens = {'input': 0, 'output': 0}
-code_editor_tokens = {'input': 0, 'output': 0}
-code_execution_tokens = {'input': 0, 'output': 0}
+main_model_tokens = TokenStats()
+tool_checker_tokens = TokenStats()
+code_editor_tokens = TokenStats()
+code_execution_tokens = TokenStats()
+# 所有模型的token和成本总计，在每次记录用量时同步累加，显示时无需重新求和
+token_totals = TokenStats()
+
+def record_usage(stats, model, usage):
+    """
+    把一次API调用的token用量和成本累加到对应模型的统计和总计中。
+
+    参数:
+    stats (TokenStats): 模型的token统计。
+    model (str): MODEL_COSTS中的模型名称。
+    usage: API响应中的usage对象。
+    """
+    cache_creation = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+    cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+    rates = MODEL_COSTS[model]
+    cost = (usage.input_tokens * rates["input"] + usage.output_tokens * rates["output"]
+            + cache_creation * rates["cache_write"] + cache_read * rates["cache_read"]) / 1_000_000
+    stats.add(usage.input_tokens, usage.output_tokens, cache_creation, cache_read, cost)
+    token_totals.add(usage.input_tokens, usage.output_tokens, cache_creation, cache_read, cost)
+
+# 对话历史和代码编辑器记忆的窗口大小（可根据模型的上下文长度调整）
+CONVERSATION_HISTORY_SIZE = 40
+CODE_EDITOR_MEMORY_SIZE = 8
+# 对话历史中所有消息内容的最大总字符数（文本按长度计算，其他内容块按JSON序列化后的长度计算）
+CONVERSATION_HISTORY_MAX_CHARS = 200_000
+# 图像按固定字符数计入上限，不计算其base64数据
+IMAGE_HISTORY_CHARS = 6_000
+# 每次请求发送给MAINMODEL的最近历史消息条数
+HISTORY_SEND_WINDOW = 20
 
 # 使用模糊搜索的标志
 USE_FUZZY_SEARCH = True
+# 模糊匹配时应用编辑所需的最低相似度
+FUZZY_MATCH_CUTOFF = 0.8
+
+# 显示调试面板（如工具输入）的标志，可通过环境变量VERBOSE=1开启
+VERBOSE = os.getenv("VERBOSE", "0").lower() in ("1", "true", "yes")
+
+# 每隔多少轮对话显示一次完整的token使用表格，其余轮次只显示一行总计（可通过环境变量CE_DISPLAY_EVERY设置）
+TOKEN_DISPLAY_EVERY = max(1, int(os.getenv("CE_DISPLAY_EVERY", "1")))
+_token_display_turns = itertools.count(1)
+
+# 消息标志位，在消息写入历史时计算一次，之后按位判断而不再扫描消息内容
+MSG_USER_TURN_START = 1  # 用户输入，一轮对话的开始
+MSG_TOOL_RESULT = 2  # 包含tool_result的用户消息
+
+def message_flags(message):
+    """
+    计算消息的标志位。
+
+    参数:
+    message (dict): 对话消息。
+
+    返回:
+    int: MSG_*标志位的组合。
+    """
+    if is_tool_result_message(message):
+        return MSG_TOOL_RESULT
+    return MSG_USER_TURN_START if message['role'] == 'user' else 0
+
+class BoundedHistory(collections.deque):
+    """
+    同时限制消息条数和总字符数的对话历史。图像按固定字符数计入，单条消息最多按总字符数上限的四分之一计入。
+    超出任一上限时从最旧的消息开始丢弃；丢弃tool_use后，紧随其后、已经没有对应tool_use的tool_result消息也一并丢弃。
+    每条消息的字符数、估计token数和标志位在写入时计算一次，按列保存在与消息平行的deque中。
+    """
+
+    def __init__(self, iterable=(), maxlen=CONVERSATION_HISTORY_SIZE, max_chars=CONVERSATION_HISTORY_MAX_CHARS):
+        super().__init__()
+        self.max_messages = maxlen
+        self.max_chars = max_chars
+        self.chars = 0
+        self.sizes = collections.deque()
+        self.tokens = collections.deque()
+        self.flags = collections.deque()
+        self.extend(iterable)
+
+    @staticmethod
+    def content_chars(content):
+        if isinstance(content, str):
+            return len(content)
+        chars = 0
+        for block in content:
+            block_type = block.get("type")
+            if block_type == "text":
+                chars += len(block["text"])
+            elif block_type == "image":
+                chars += IMAGE_HISTORY_CHARS
+            elif block_type == "tool_result":
+                chars += BoundedHistory.content_chars(block.get("content", ""))
+            else:
+                chars += len(jdumps(block))
+        return chars
+
+    def message_chars(self, message):
+        # 单条消息最多按上限的四分之一计入，一条过大的消息（如大段执行输出）不会挤掉全部历史
+        return min(self.content_chars(message["content"]), self.max_chars // 4)
+
+    def append(self, message):
+        size = self.message_chars(message)
+        super().append(message)
+        self.sizes.append(size)
+        self.tokens.append(message_tokens(message))
+        self.flags.append(message_flags(message))
+        self.chars += size
+        while len(self) > 1 and (len(self) > self.max_messages or self.chars > self.max_chars):
+            self.popleft()
+            # 历史开头的tool_result已经失去对应的tool_use，发送时会被API拒绝
+            while len(self) > 1 and self.flags[0] & MSG_TOOL_RESULT:
+                self.popleft()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def popleft(self):
+        message = super().popleft()
+        self.chars -= self.sizes.popleft()
+        self.tokens.popleft()
+        self.flags.popleft()
+        return message
+
+    def clear(self):
+        super().clear()
+        self.sizes.clear()
+        self.tokens.clear()
+        self.flags.clear()
+        self.chars = 0
+
+    def recent(self, k):
+        """
+        返回最近k条消息及其估计token数和标志位，三者一一对应。
+
+        参数:
+        k (int): 消息条数。
+
+        返回:
+        tuple: (消息列表, token数列表, 标志位列表)。
+        """
+        start = max(0, len(self) - k)
+        return tuple(list(itertools.islice(column, start, None)) for column in (self, self.tokens, self.flags))
+
+# 设置对话记忆（维护MAINMODEL的上下文），只保留最近CONVERSATION_HISTORY_SIZE条、总计不超过CONVERSATION_HISTORY_MAX_CHARS字符的消息
+conversation_history = BoundedHistory()
+
+# 持久对话历史：与conversation_history相同，但不包含只用于把文件内容加载进系统提示的工具调用，发送给模型时使用
+durable_conversation_history = BoundedHistory()
+
+# 存储文件内容（MAINMODEL的上下文的一部分），按最近写入的顺序排列，超出上限时淘汰最久未更新的文件
+file_contents = collections.OrderedDict()
 
-# 设置对话记忆（维护MAINMODEL的上下文）
-conversation_history = []
+# 单个文件写入系统提示的最大字符数，超出部分被截断
+MAX_FILE_CHARS = 64 * 1024
+# 系统提示中所有文件内容的最大总字符数
+MAX_CONTEXT_CHARS = 512 * 1024
+FILE_TRUNCATED_MARKER = "\n...[truncated]"
 
-# 存储文件内容（MAINMODEL的上下文的一部分）
-file_contents = {}
+# file_contents中被截断的文件，编辑这些文件时必须从磁盘读取完整内容
+_truncated_files = set()
 
-# 代码编辑器记忆（在调用之间维护CODEEDITORMODEL的一些上下文）
-code_editor_memory = []
+# 代码编辑器记忆（在调用之间维护CODEEDITORMODEL的一些上下文），只保留最近CODE_EDITOR_MEMORY_SIZE条
+code_editor_memory = collections.deque(maxlen=CODE_EDITOR_MEMORY_SIZE)
 
 # 代码编辑器上下文中已经存在的文件
 code_editor_files = set()
@@ -171,16 +511,49 @@ code_editor_files = set()
 # 自动模式标志
 automode = False
 
-# 存储文件内容
-file_contents = {}
+# 系统提示中文件内容部分的缓存，file_contents变化时标记为dirty后重建
+_file_contents_cache = {'text': '', 'dirty': True, 'size': 0, 'tokens': 0}
 
-# 存储正在运行的进程的全局字典
-running_processes = {}
+# update_system_prompt上次返回的内容块及其参数，参数和文件内容都未变化时直接复用，保证发送的系统提示字节完全一致
+_system_prompt_cache = {'key': None, 'blocks': None, 'tokens': 0}
+
+# 自动模式下工具检查器响应的LRU缓存，键为本轮工具调用及结果的摘要
+TOOL_CHECKER_CACHE_SIZE = 128
+_tool_checker_cache = collections.OrderedDict()
+
+# 本进程中已经创建过的目录，create_files对这些目录不再调用makedirs
+_dirs_created = set()
+
+# list_files的目录列表缓存：绝对路径 -> (目录修改时间, 文件列表)
+_listdir_cache = {}
+# 文件系统时间戳精度有限，修改时间距今不足该值（纳秒）的目录可能在同一时间戳内再次变化，不缓存其列表
+LISTDIR_RACY_NS = 1_000_000_000
+
+# 存储正在运行的进程的全局字典，按启动顺序排列，超过MAX_RUNNING_PROCESSES时终止最早的进程
+running_processes = collections.OrderedDict()
+MAX_RUNNING_PROCESSES = 16
+
+# 后台回收进程的任务，保留引用以免任务被垃圾回收
+_reaper_tasks = set()
+
+# 进程ID计数器，结束的进程会从running_processes中移除，因此不能用字典长度生成ID
+_process_counter = itertools.count()
 
 # 常量
 CONTINUATION_EXIT_PHRASE = "AUTOMODE_COMPLETE"
+# 这些工具成功把文件内容写入系统提示后，该工具调用不写入持久对话历史
+EPHEMERAL_TOOLS = frozenset({"create_files", "read_file", "read_multiple_files"})
 MAX_CONTINUATION_ITERATIONS = 25
 MAX_CONTEXT_TOKENS = 200000  # 将上下文窗口的最大token数减少到200k
+CONTEXT_OUTPUT_RESERVE = 4096  # 发送请求前为模型输出（max_tokens）保留的上下文token数
+
+# 各模型每百万token的价格（美元），以及该模型的token是否计入上下文
+MODEL_COSTS = {
+    "Main Model": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": True},
+    "Tool Checker": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": False},
+    "Code Editor": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": True},
+    "Code Execution": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": False}
+}
 
 # 模型名称
 MAINMODEL = "claude-3-5-sonnet-20240620"
@@ -250,6 +623,7 @@ When using tools:
 
 Remember, you are an AI assistant, and your primary goal is to help the user accomplish their tasks effectively and efficiently while maintaining the integrity and security of their development environment.
 """
+BASE_SYSTEM_PROMPT_TOKENS = count_tokens(BASE_SYSTEM_PROMPT)
 
 AUTOMODE_SYSTEM_PROMPT = """
 You are currently in automode. Follow these guidelines:
@@ -287,38 +661,236 @@ You are currently in automode. Follow these guidelines:
 Remember: Focus on completing the established goals efficiently and effectively. Avoid unnecessary conversations or requests for additional tasks.
 """
 
-def update_system_prompt(current_iteration: Optional[int] = None, max_iterations: Optional[int] = None) -> str:
+CODE_EDITOR_SYSTEM_PROMPT = """
+You are an AI coding agent that generates edit instructions for code files. Your task is to analyze the provided code and generate SEARCH/REPLACE blocks for necessary changes. Follow these steps:
+
+1. Review the entire file content (under "File content") to understand the context.
+
+2. Carefully analyze the specific instructions (under "Instructions").
+
+3. Take into account the overall project context (under "Project context").
+
+4. Consider the memory of previous edits (under "Memory of previous edits").
+
+5. Consider the full context of all files in the project (under "Full context of all files in the project").
+
+6. Generate SEARCH/REPLACE blocks for each necessary change. Each block should:
+   - Include enough context to uniquely identify the code to be changed
+   - Provide the exact replacement code, maintaining correct indentation and formatting
+   - Focus on specific, targeted changes rather than large, sweeping modifications
+
+7. Ensure that your SEARCH/REPLACE blocks:
+   - Address all relevant aspects of the instructions
+   - Maintain or enhance code readability and efficiency
+   - Consider the overall structure and purpose of the code
+   - Follow best practices and coding standards for the language
+   - Maintain consistency with the project context and previous edits
+   - Take into account the full context of all files in the project
+
+IMPORTANT: RETURN ONLY THE SEARCH/REPLACE BLOCKS. NO EXPLANATIONS OR COMMENTS.
+USE THE FOLLOWING FORMAT FOR EACH BLOCK:
+
+<SEARCH>
+Code to be replaced
+</SEARCH>
+<REPLACE>
+New code to insert
+</REPLACE>
+
+If no changes are needed, return an empty list.
+"""
+
+# 思维链提示，追加在系统提示末尾
+CHAIN_OF_THOUGHT_PROMPT = """
+    Answer the user's request using relevant tools (if they are available). Before calling a tool, do some analysis within <thinking></thinking> tags. First, think about which of the provided tools is the relevant tool to answer the user's request. Second, go through each of the required parameters of the relevant tool and determine if the user has directly provided or given enough information to infer a value. When deciding if the parameter can be inferred, carefully consider all the context to see if it supports a specific value. If all of the required parameters are present or can be reasonably inferred, close the thinking tag and proceed with the tool call. BUT, if one of the values for a required parameter is missing, DO NOT invoke the function (not even with fillers for the missing params) and instead, ask the user to provide the missing parameters. DO NOT ask for more information on optional parameters if it is not provided.
+
+    Do not reflect on the quality of the returned search results in your response.
+    """
+
+# 系统提示中除文件内容和迭代信息外的部分在模块加载时预先拼好，每次调用只需拼接变化的部分
+_PROMPT_TAIL = "\n\n" + CHAIN_OF_THOUGHT_PROMPT
+_AUTOMODE_PROMPT_HEAD, _AUTOMODE_PROMPT_TAIL = AUTOMODE_SYSTEM_PROMPT.split("{iteration_info}")
+_AUTOMODE_PROMPT_HEAD = "\n\n" + _AUTOMODE_PROMPT_HEAD
+_AUTOMODE_PROMPT_TAIL = _AUTOMODE_PROMPT_TAIL + _PROMPT_TAIL
+
+def set_file_content(path, content):
+    """
+    更新file_contents中的文件内容，并标记系统提示中的文件内容缓存需要重建。
+    过大的文件会被截断；文件内容总大小超过MAX_CONTEXT_CHARS时淘汰最久未更新的文件。
+
+    参数:
+    path (str): 文件路径。
+    content (str): 文件内容。
+    """
+    if len(content) > MAX_FILE_CHARS:
+        content = content[:MAX_FILE_CHARS] + FILE_TRUNCATED_MARKER
+        _truncated_files.add(path)
+    else:
+        _truncated_files.discard(path)
+
+    previous = file_contents.pop(path, None)
+    if previous is not None:
+        _file_contents_cache['size'] -= len(previous)
+    file_contents[path] = content
+    _file_contents_cache['size'] += len(content)
+
+    while _file_contents_cache['size'] > MAX_CONTEXT_CHARS and len(file_contents) > 1:
+        evicted_path, evicted = file_contents.popitem(last=False)
+        _file_contents_cache['size'] -= len(evicted)
+        _truncated_files.discard(evicted_path)
+    _file_contents_cache['dirty'] = True
+
+def truncation_note(path):
+    """
+    返回文件在系统提示中被截断时附加到工具结果的说明，未截断时返回空字符串。
+    """
+    if path in _truncated_files:
+        return f" Only the first {MAX_FILE_CHARS} characters are included because the file is large."
+    return ""
+
+def update_system_prompt(current_iteration: Optional[int] = None, max_iterations: Optional[int] = None) -> list:
     """
     更新系统提示的函数。
+    不变的BASE_SYSTEM_PROMPT放在第一个内容块，文件内容和迭代信息等变化的部分放在第二个内容块，
+    两个块都设置缓存断点，文件内容变化时静态部分仍能命中提示缓存。
     
     参数:
     current_iteration (Optional[int]): 当前迭代次数。
     max_iterations (Optional[int]): 最大迭代次数。
     
     返回:
-    str: 更新后的系统提示字符串。
-
-    调用的外部函数:
-    - json.dumps(): 将Python对象转换为JSON字符串。
+    list: 系统提示内容块列表。
     """
     global file_contents
-    chain_of_thought_prompt = """
-    Answer the user's request using relevant tools (if they are available). Before calling a tool, do some analysis within <thinking></thinking> tags. First, think about which of the provided tools is the relevant tool to answer the user's request. Second, go through each of the required parameters of the relevant tool and determine if the user has directly provided or given enough information to infer a value. When deciding if the parameter can be inferred, carefully consider all the context to see if it supports a specific value. If all of the required parameters are present or can be reasonably inferred, close the thinking tag and proceed with the tool call. BUT, if one of the values for a required parameter is missing, DO NOT invoke the function (not even with fillers for the missing params) and instead, ask the user to provide the missing parameters. DO NOT ask for more information on optional parameters if it is not provided.
-
-    Do not reflect on the quality of the returned search results in your response.
-    """
     
-    file_contents_prompt = "\n\nFile Contents:\n"
-    for path, content in file_contents.items():
-        file_contents_prompt += f"\n--- {path} ---\n{content}\n"
+    # 只有file_contents发生变化时才重建文件内容部分
+    if _file_contents_cache['dirty']:
+        _file_contents_cache['text'] = "\n\nFile Contents:\n" + "".join(
+            f"\n--- {path} ---\n{content}\n" for path, content in file_contents.items()
+        )
+        _file_contents_cache['tokens'] = count_tokens(_file_contents_cache['text'])  # 只在文件内容变化时重新计算
+        _file_contents_cache['dirty'] = False
+        _system_prompt_cache['key'] = None
+    file_contents_prompt = _file_contents_cache['text']
+
+    key = (automode, current_iteration, max_iterations)
+    if _system_prompt_cache['key'] == key:
+        return _system_prompt_cache['blocks']  # 调用方不得修改返回的列表
     
     if automode:
         iteration_info = ""
         if current_iteration is not None and max_iterations is not None:
             iteration_info = f"You are currently on iteration {current_iteration} out of {max_iterations} in automode."
-        return BASE_SYSTEM_PROMPT + file_contents_prompt + "\n\n" + AUTOMODE_SYSTEM_PROMPT.format(iteration_info=iteration_info) + "\n\n" + chain_of_thought_prompt
+        prompt_tail = "".join((_AUTOMODE_PROMPT_HEAD, iteration_info, _AUTOMODE_PROMPT_TAIL))
     else:
-        return BASE_SYSTEM_PROMPT + file_contents_prompt + "\n\n" + chain_of_thought_prompt
+        prompt_tail = _PROMPT_TAIL
+    dynamic_prompt = file_contents_prompt + prompt_tail
+    blocks = [
+        {"type": "text", "text": BASE_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": dynamic_prompt, "cache_control": {"type": "ephemeral"}},
+    ]
+    _system_prompt_cache['key'] = key
+    _system_prompt_cache['blocks'] = blocks
+    _system_prompt_cache['tokens'] = BASE_SYSTEM_PROMPT_TOKENS + _file_contents_cache['tokens'] + count_tokens(prompt_tail)
+    return blocks
+
+def system_prompt_tokens():
+    """
+    返回update_system_prompt()上次返回的系统提示的估计token数。
+
+    返回:
+    int: 估计的token数。
+    """
+    return _system_prompt_cache['tokens']
+
+def with_cache_breakpoint(messages):
+    """
+    返回在最后一条消息上设置了缓存断点的消息列表副本。
+    只复制最后一条消息，不修改会写入对话历史的原始消息，避免历史中累积多余的缓存断点。
+
+    参数:
+    messages (list): 要发送的消息列表。
+
+    返回:
+    list: 设置了缓存断点的消息列表。
+    """
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+    return messages[:-1] + [{**last, "content": content}]
+
+def tool_checker_cache_key(tool_use_blocks, tool_result_blocks):
+    """
+    计算本轮工具调用及结果的摘要，作为工具检查器响应缓存的键。
+    read_file、edit_and_apply_multiple等工具的结果只是一行状态信息，工具检查器实际分析的文件内容在系统提示中，
+    因此摘要同时包含file_contents中所有文件的路径和内容，文件变化后不会复用变化前的响应。
+
+    参数:
+    tool_use_blocks (list): 本轮的tool_use内容块。
+    tool_result_blocks (list): 对应的tool_result内容块。
+
+    返回:
+    bytes: blake2b摘要。
+
+    调用的外部函数:
+    - json.dumps(): 以排序后的键序列化，保证相同的输入得到相同的摘要。
+    - hashlib.blake2b(): 计算摘要。
+    """
+    canonical = json.dumps(
+        [(use["name"], use["input"], result["content"], result["is_error"]) for use, result in zip(tool_use_blocks, tool_result_blocks)],
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    digest = hashlib.blake2b(canonical.encode(), digest_size=16)
+    for path, content in file_contents.items():
+        digest.update(f"\0{len(path)}:{path}{len(content)}:".encode())
+        digest.update(content.encode())
+    return digest.digest()
+
+def get_cached_tool_checker_response(key):
+    """
+    查找缓存的工具检查器响应，命中时将其移到LRU末尾。
+
+    参数:
+    key (bytes): tool_checker_cache_key()返回的摘要。
+
+    返回:
+    Optional[str]: 缓存的响应文本，未命中时为None。
+    """
+    response = _tool_checker_cache.get(key)
+    if response is not None:
+        _tool_checker_cache.move_to_end(key)
+    return response
+
+def cache_tool_checker_response(key, response):
+    """
+    缓存工具检查器响应，超过TOOL_CHECKER_CACHE_SIZE时丢弃最久未使用的条目。
+
+    参数:
+    key (bytes): tool_checker_cache_key()返回的摘要。
+    response (str): 工具检查器响应文本。
+    """
+    _tool_checker_cache[key] = response
+    _tool_checker_cache.move_to_end(key)
+    while len(_tool_checker_cache) > TOOL_CHECKER_CACHE_SIZE:
+        _tool_checker_cache.popitem(last=False)
+
+def invalidate_listdir_cache(path):
+    """
+    丢弃path及其所有上级目录的list_files缓存。
+
+    参数:
+    path (str): 新建的文件或目录路径。
+    """
+    parent = os.path.abspath(path)
+    while True:
+        _listdir_cache.pop(parent, None)
+        parent, child = os.path.dirname(parent), parent
+        if parent == child:
+            break
 
 def create_folders(paths):
     """
@@ -338,6 +910,8 @@ def create_folders(paths):
         try:
             # 创建文件夹，若已存在则不报错
             os.makedirs(path, exist_ok=True)
+            _dirs_created.add(path)  # 记录已创建的目录
+            invalidate_listdir_cache(path)
             results.append(f"Folder created: {path}")
         except Exception as e:
             results.append(f"Error creating folder {path}: {str(e)}")
@@ -351,7 +925,7 @@ def create_files(files):
     files (list): 要创建的文件信息列表，每个文件包含路径和内容。
     
     返回:
-    str: 创建文件的结果信息。
+    tuple: 创建文件的结果信息和已写入系统提示的文件路径列表。
 
     调用的外部函数:
     - os.path.dirname(): 获取文件路径的目录部分。
@@ -359,6 +933,7 @@ def create_files(files):
     """
     global file_contents
     results = []
+    updated_paths = []
     # 处理单个文件和多个文件的情况
     if isinstance(files, dict):
         files = [files]
@@ -367,15 +942,28 @@ def create_files(files):
             path = file['path']  # 获取文件路径
             content = file['content']  # 获取文件内容
             dir_name = os.path.dirname(path)  # 获取文件所在目录
-            if dir_name:
+            if dir_name and dir_name not in _dirs_created:
                 os.makedirs(dir_name, exist_ok=True)  # 创建目录
-            with open(path, 'w') as f:
-                f.write(content)  # 写入文件内容
-            file_contents[path] = content  # 更新文件内容到全局字典
+                _dirs_created.add(dir_name)  # 记录已创建的目录，之后不再重复调用makedirs
+            try:
+                with open(path, 'w') as f:
+                    f.write(content)  # 写入文件内容
+            except FileNotFoundError:
+                if not dir_name:
+                    raise
+                # 记录过的目录可能已被删除（例如execute_code运行的代码），重新创建后重试一次
+                _dirs_created.discard(dir_name)
+                os.makedirs(dir_name, exist_ok=True)
+                _dirs_created.add(dir_name)
+                with open(path, 'w') as f:
+                    f.write(content)
+            invalidate_listdir_cache(path)
+            set_file_content(path, content)  # 更新文件内容到全局字典
+            updated_paths.append(path)
             results.append(f"File created and added to system prompt: {path}")
         except Exception as e:
             results.append(f"Error creating file {path}: {str(e)}")
-    return "\n".join(results)
+    return "\n".join(results), updated_paths
 
 async def generate_edit_instructions(file_path, file_content, instructions, project_context, full_file_contents):
     """
@@ -407,70 +995,41 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
             if path != file_path or path not in code_editor_files
         ])
 
-        system_prompt = f"""
-        You are an AI coding agent that generates edit instructions for code files. Your task is to analyze the provided code and generate SEARCH/REPLACE blocks for necessary changes. Follow these steps:
-
-        1. Review the entire file content to understand the context:
-        {file_content}
-
-        2. Carefully analyze the specific instructions:
-        {instructions}
-
-        3. Take into account the overall project context:
-        {project_context}
-
-        4. Consider the memory of previous edits:
-        {memory_context}
-
-        5. Consider the full context of all files in the project:
-        {full_file_contents_context}
-
-        6. Generate SEARCH/REPLACE blocks for each necessary change. Each block should:
-           - Include enough context to uniquely identify the code to be changed
-           - Provide the exact replacement code, maintaining correct indentation and formatting
-           - Focus on specific, targeted changes rather than large, sweeping modifications
-
-        7. Ensure that your SEARCH/REPLACE blocks:
-           - Address all relevant aspects of the instructions
-           - Maintain or enhance code readability and efficiency
-           - Consider the overall structure and purpose of the code
-           - Follow best practices and coding standards for the language
-           - Maintain consistency with the project context and previous edits
-           - Take into account the full context of all files in the project
-
-        IMPORTANT: RETURN ONLY THE SEARCH/REPLACE BLOCKS. NO EXPLANATIONS OR COMMENTS.
-        USE THE FOLLOWING FORMAT FOR EACH BLOCK:
-
-        <SEARCH>
-        Code to be replaced
-        </SEARCH>
-        <REPLACE>
-        New code to insert
-        </REPLACE>
-
-        If no changes are needed, return an empty list.
-        """
+        # 系统提示按从稳定到易变的顺序拆分为多个块，使静态前缀能够命中提示缓存
+        system_blocks = [
+            {
+                "type": "text",
+                "text": CODE_EDITOR_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ]
+        if full_file_contents_context:
+            system_blocks.append({
+                "type": "text",
+                "text": f"Full context of all files in the project:\n{full_file_contents_context}",
+                "cache_control": {"type": "ephemeral"}
+            })
+        system_blocks.append({
+            "type": "text",
+            "text": (
+                f"File content:\n{file_content}\n\n"
+                f"Instructions:\n{instructions}\n\n"
+                f"Project context:\n{project_context}\n\n"
+                f"Memory of previous edits:\n{memory_context}"
+            )
+        })
 
-        response = client.beta.prompt_caching.messages.create(
+        response = await client.beta.prompt_caching.messages.create(
             model=CODEEDITORMODEL,
             max_tokens=4096,
-            system=[
-                {
-                    "type": "text",
-                    "text": system_prompt,
-                    "cache_control": {"type": "ephemeral"}
-                }
-            ],
+            system=system_blocks,
             messages=[
                 {"role": "user", "content": "Generate SEARCH/REPLACE blocks for the necessary changes."}
             ],
             extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
         )
         # 更新代码编辑器的token使用情况
-        code_editor_tokens['input'] += response.usage.input_tokens
-        code_editor_tokens['output'] += response.usage.output_tokens
-        code_editor_tokens['cache_creation'] = response.usage.cache_creation_input_tokens
-        code_editor_tokens['cache_read'] = response.usage.cache_read_input_tokens
+        record_usage(code_editor_tokens, "Code Editor", response.usage)
 
         # 解析响应以提取SEARCH/REPLACE块
         edit_instructions = parse_search_replace_blocks(response.content[0].text)
@@ -487,44 +1046,78 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
         console.print(f"Error in generating edit instructions: {str(e)}", style="bold red")
         return []  # 如果发生任何异常，则返回空列表
 
-def parse_search_replace_blocks(response_text, use_fuzzy=USE_FUZZY_SEARCH):
+def find_fuzzy_match(search_content, content, cutoff=0.6, lines=None):
+    """
+    在内容中按行窗口查找与搜索内容最相似的片段。
+
+    参数:
+    search_content (str): 要查找的内容。
+    content (str): 被搜索的完整内容。
+    cutoff (float): 最低相似度，低于该值的候选片段被忽略。
+    lines (Optional[list]): 预先按行切分（保留换行符）的内容，避免重复切分。
+
+    返回:
+    Optional[Tuple[int, int, float]]: 最佳匹配的起止位置和相似度，没有匹配时返回None。
+
+    调用的外部函数:
+    - difflib.SequenceMatcher(): 计算两个序列的相似度。
+    """
+    if lines is None:
+        lines = content.splitlines(keepends=True)
+    window = search_content.count('\n') + 1  # 候选窗口的行数与搜索内容一致
+    offsets = [0]  # 每一行在内容中的起始位置
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    # 搜索内容作为seq2只设置一次，SequenceMatcher会保留为它构建的b2j索引，每个窗口只需替换seq1
+    matcher = difflib.SequenceMatcher(None, autojunk=False)
+    matcher.set_seq2(search_content)
+
+    best = None
+    best_ratio = cutoff
+    for i in range(len(lines) - window + 1):
+        candidate = ''.join(lines[i:i + window])
+        stripped = candidate.strip()
+        matcher.set_seq1(stripped)
+        # 先用廉价的上界估计跳过不可能超过当前最佳的窗口
+        if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+            continue
+        ratio = matcher.ratio()
+        if ratio >= best_ratio:
+            start = offsets[i] + len(candidate) - len(candidate.lstrip())
+            best = (start, start + len(stripped), ratio)
+            best_ratio = ratio
+    return best
+
+# 解析出的单个SEARCH/REPLACE块
+EditBlock = collections.namedtuple('EditBlock', 'search replace similarity')
+
+# 预编译的SEARCH/REPLACE块模式，避免每次调用时重新编译
+_BLOCK_RE = re.compile(r'<SEARCH>\s*(.*?)\s*</SEARCH>\s*<REPLACE>\s*(.*?)\s*</REPLACE>', re.DOTALL)
+
+def parse_search_replace_blocks(response_text):
     """
     解析响应文本中的SEARCH/REPLACE块。
 
     参数:
     response_text (str): 包含SEARCH/REPLACE块的文本。
-    use_fuzzy (bool): 是否对搜索块使用模糊匹配。
 
     返回:
-    list: 包含'search'、'replace'和'similarity'键的字典列表。
+    list: EditBlock列表，每个EditBlock包含search、replace和similarity字段。
 
     调用的外部函数:
-    - re.findall(): 查找所有匹配的子字符串。
-    - difflib.get_close_matches(): 查找最接近的匹配。
-    - difflib.SequenceMatcher().ratio(): 计算两个序列的相似度。
+    - _BLOCK_RE.findall(): 查找所有匹配的SEARCH/REPLACE块。
     """
     blocks = []
-    pattern = r'<SEARCH>\s*(.*?)\s*</SEARCH>\s*<REPLACE>\s*(.*?)\s*</REPLACE>'
-    matches = re.findall(pattern, response_text, re.DOTALL)
+    matches = _BLOCK_RE.findall(response_text)
     
     for search, replace in matches:
         search = search.strip()  # 去除搜索内容的前后空格
-        replace = replace.strip()  # 去除替换内容的前后空格
-        similarity = 1.0  # 默认相似度为完全匹配
-
-        if use_fuzzy and search not in response_text:
-            # 在这里实现模糊匹配逻辑
-            best_match = difflib.get_close_matches(search, [response_text], n=1, cutoff=0.6)
-            if best_match:
-                similarity = difflib.SequenceMatcher(None, search, best_match[0]).ratio()  # 计算相似度
-            else:
-                similarity = 0.0  # 如果没有找到最佳匹配，则相似度为0
+        # 去除替换内容中残留的<SEARCH>和<REPLACE>标签以及前后空格
+        replace = replace.replace('<SEARCH>', '').replace('</SEARCH>', '').replace('<REPLACE>', '').replace('</REPLACE>', '').strip()
 
-        blocks.append({
-            'search': search,
-            'replace': replace,
-            'similarity': similarity
-        })
+        # 相似度在apply_edits中精确匹配失败时才计算
+        blocks.append(EditBlock(search, replace, None))
     
     return blocks
 
@@ -539,9 +1132,10 @@ async def edit_and_apply_multiple(files, project_context, is_automode=False, max
     max_retries (int): 最大重试次数。
     
     返回:
-    tuple: 包含结果信息和控制台输出的元组。
+    tuple: 包含结果信息、控制台输出和已更新到系统提示的文件路径列表的元组。
 
     调用的外部函数:
+    - asyncio.to_thread(): 在线程池中读取尚未缓存的文件。
     - generate_edit_instructions(): 生成编辑指令。
     - apply_edits(): 应用编辑指令。
     - console.print(): 打印信息到控制台。
@@ -549,15 +1143,30 @@ async def edit_and_apply_multiple(files, project_context, is_automode=False, max
     global file_contents
     results = []
     console_outputs = []
+    updated_paths = []
+
+    # 在线程池中并发读取尚未缓存或在系统提示中被截断的文件，避免逐个阻塞事件循环
+    missing_paths = list(dict.fromkeys(
+        file['path'] for file in files
+        if not file_contents.get(file['path']) or file['path'] in _truncated_files
+    ))
+    contents = await asyncio.gather(*(asyncio.to_thread(Path(path).read_text) for path in missing_paths), return_exceptions=True)
+    # 编辑时使用的完整文件内容，file_contents中的内容可能被截断
+    full_contents = {}
+    for path, content in zip(missing_paths, contents):
+        if not isinstance(content, Exception):
+            full_contents[path] = content
+            set_file_content(path, content)  # 读取失败的文件在下面的循环中报告错误
+
     for file in files:
         path = file['path']  # 获取文件路径
         instructions = file['instructions']  # 获取编辑指令
         try:
-            original_content = file_contents.get(path, "")  # 获取原始内容
-            if not original_content:
+            original_content = full_contents.get(path) or file_contents.get(path, "")  # 获取原始内容
+            if path not in full_contents and (not original_content or path in _truncated_files):
                 with open(path, 'r') as f:
                     original_content = f.read()  # 读取文件内容
-                file_contents[path] = original_content  # 更新文件内容到全局字典
+                set_file_content(path, original_content)  # 更新文件内容到全局字典
 
             for attempt in range(max_retries):
                 # 生成编辑指令
@@ -567,14 +1176,15 @@ async def edit_and_apply_multiple(files, project_context, is_automode=False, max
                     console.print(Panel(f"File: {path}\nAttempt {attempt + 1}/{max_retries}: The following SEARCH/REPLACE blocks have been generated:", title="Edit Instructions", style="cyan"))
                     for i, block in enumerate(edit_instructions, 1):
                         console.print(f"Block {i}:")
-                        console.print(Panel(f"SEARCH:\n{block['search']}\n\nREPLACE:\n{block['replace']}\nSimilarity: {block['similarity']:.2f}", expand=False))
+                        console.print(Panel(f"SEARCH:\n{block.search}\n\nREPLACE:\n{block.replace}", expand=False))
 
                     # 应用编辑
                     edited_content, changes_made, failed_edits, console_output = await apply_edits(path, edit_instructions, original_content)
                     console_outputs.append(console_output)
 
                     if changes_made:
-                        file_contents[path] = edited_content  # 更新文件内容
+                        full_contents[path] = edited_content
+                        set_file_content(path, edited_content)  # 更新文件内容
                         console.print(Panel(f"File contents updated in system prompt: {path}", style="green"))
 
                         if failed_edits:
@@ -584,6 +1194,7 @@ async def edit_and_apply_multiple(files, project_context, is_automode=False, max
                             continue
 
                         results.append(f"Changes applied to {path}")  # 记录成功应用的更改
+                        updated_paths.append(path)
                         break
                     elif attempt == max_retries - 1:
                         results.append(f"No changes could be applied to {path} after {max_retries} attempts. Please review the edit instructions and try again.")
@@ -600,7 +1211,7 @@ async def edit_and_apply_multiple(files, project_context, is_automode=False, max
             results.append(error_message)
             console_outputs.append(error_message)
 
-    return "\n".join(results), "\n".join(console_outputs)
+    return "\n".join(results), "\n".join(console_outputs), updated_paths
 
 async def apply_edits(file_path, edit_instructions, original_content):
     """
@@ -615,16 +1226,17 @@ async def apply_edits(file_path, edit_instructions, original_content):
     tuple: 包含编辑后的内容、是否有更改、失败的编辑和控制台输出的元组。
 
     调用的外部函数:
-    - re.compile(): 编译正则表达式模式。
-    - re.escape(): 转义正则表达式中的特殊字符。
-    - re.sub(): 替换字符串中的匹配项。
-    - difflib.get_close_matches(): 查找最接近的匹配。
+    - str.find(): 查找搜索内容的精确匹配位置。
+    - find_fuzzy_match(): 按行窗口查找最相似的片段。
     - generate_diff(): 生成原始内容和新内容之间的差异。
     - console.print(): 打印信息到控制台。
     - Progress(): 创建进度条。
     """
+    from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn  # 只在应用编辑时才需要进度条
+
     changes_made = False  # 记录是否有更改
     edited_content = original_content  # 初始化编辑后的内容
+    edited_lines = None  # 按行切分的编辑后内容，只在模糊匹配时计算，内容变化后失效
     total_edits = len(edit_instructions)  # 获取总编辑数
     failed_edits = []  # 记录失败的编辑
     console_output = []  # 控制台输出
@@ -639,40 +1251,38 @@ async def apply_edits(file_path, edit_instructions, original_content):
         edit_task = progress.add_task("[cyan]Applying edits...", total=total_edits)  # 添加进度任务
 
         for i, edit in enumerate(edit_instructions, 1):
-            search_content = edit['search'].strip()  # 获取搜索内容并去除空格
-            replace_content = edit['replace'].strip()  # 获取替换内容并去除空格
-            similarity = edit['similarity']  # 获取相似度
-
-            # 使用正则表达式查找内容，忽略前后空格
-            pattern = re.compile(re.escape(search_content), re.DOTALL)
-            match = pattern.search(edited_content)
-            
-            if match or (USE_FUZZY_SEARCH and similarity >= 0.8):
-                if not match:
-                    # 如果使用模糊搜索且没有精确匹配，找到最佳匹配
-                    best_match = difflib.get_close_matches(search_content, [edited_content], n=1, cutoff=0.6)
+            search_content = edit.search.strip()  # 获取搜索内容并去除空格
+            replace_content = edit.replace.strip()  # 获取替换内容并去除空格
+            # 精确匹配直接使用str.find（C实现的子串搜索），无需构造正则表达式
+            start = edited_content.find(search_content)
+            if start != -1:
+                match = (start, start + len(search_content))
+                similarity = 1.0  # 精确匹配
+            else:
+                match = None
+                similarity = 0.0
+                if USE_FUZZY_SEARCH:
+                    # 只有精确匹配失败时才进行模糊匹配，按行窗口找到最佳匹配
+                    if edited_lines is None:
+                        edited_lines = edited_content.splitlines(keepends=True)
+                    best_match = find_fuzzy_match(search_content, edited_content, cutoff=FUZZY_MATCH_CUTOFF, lines=edited_lines)
                     if best_match:
-                        match = re.search(re.escape(best_match[0]), edited_content)
-
-                if match:
-                    # 替换内容，保留原始空格
-                    start, end = match.span()
-                    # 去除<SEARCH>和<REPLACE>标签
-                    replace_content_cleaned = re.sub(r'</?SEARCH>|</?REPLACE>', '', replace_content)
-                    edited_content = edited_content[:start] + replace_content_cleaned + edited_content[end:]
-                    changes_made = True  # 标记已更改
-
-                    # 显示此编辑的差异
-                    diff_result = generate_diff(search_content, replace_content, file_path)
-                    console.print(Panel(diff_result, title=f"Changes in {file_path} ({i}/{total_edits}) - Similarity: {similarity:.2f}", style="cyan"))
-                    console_output.append(f"Edit {i}/{total_edits} applied successfully")  # 记录成功应用的编辑
-                else:
-                    message = f"Edit {i}/{total_edits} not applied: content not found (Similarity: {similarity:.2f})"  # 记录未应用的编辑
-                    console_output.append(message)
-                    console.print(Panel(message, style="yellow"))
-                    failed_edits.append(f"Edit {i}: {search_content}")  # 记录失败的编辑
+                        match = best_match[:2]
+                        similarity = best_match[2]
+
+            if match:
+                # 替换内容，保留原始空格
+                start, end = match
+                edited_content = edited_content[:start] + replace_content + edited_content[end:]
+                edited_lines = None  # 内容已变化，按行切分的缓存失效
+                changes_made = True  # 标记已更改
+
+                # 显示此编辑的差异
+                diff_result = generate_diff(search_content, replace_content, file_path)
+                console.print(Panel(diff_result, title=f"Changes in {file_path} ({i}/{total_edits}) - Similarity: {similarity:.2f}", style="cyan"))
+                console_output.append(f"Edit {i}/{total_edits} applied successfully")  # 记录成功应用的编辑
             else:
-                message = f"Edit {i}/{total_edits} not applied: content not found (Similarity: {similarity:.2f})"  # 记录未应用的编辑
+                message = f"Edit {i}/{total_edits} not applied: content not found"  # 记录未应用的编辑
                 console_output.append(message)
                 console.print(Panel(message, style="yellow"))
                 failed_edits.append(f"Edit {i}: {search_content}")  # 记录失败的编辑
@@ -721,24 +1331,65 @@ def generate_diff(original, new, path):
     返回:
     Syntax: 高亮显示的差异文本对象。
 
+    调用的外部函数:
+    - generate_diff_lines(): 根据按行切分的内容生成差异。
+    """
+    return generate_diff_lines(original.splitlines(keepends=True), new.splitlines(keepends=True), path)
+
+def generate_diff_lines(original_lines, new_lines, path):
+    """
+    根据已经按行切分（保留换行符）的内容生成差异的函数，调用方已有行列表时无需重新切分。
+
+    参数:
+    original_lines (list): 原始内容的行列表。
+    new_lines (list): 新内容的行列表。
+    path (str): 文件路径。
+
+    返回:
+    Syntax: 高亮显示的差异文本对象。
+
     调用的外部函数:
     - difflib.unified_diff(): 生成统一格式的差异。
     - highlight_diff(): 高亮显示差异文本。
     """
     # 生成原始内容和新内容之间的差异
-    diff = list(difflib.unified_diff(
-        original.splitlines(keepends=True),
-        new.splitlines(keepends=True),
+    diff_text = ''.join(difflib.unified_diff(
+        original_lines,
+        new_lines,
         fromfile=f"a/{path}",
         tofile=f"b/{path}",
         n=3
     ))
-
-    diff_text = ''.join(diff)  # 将差异列表转换为字符串
     highlighted_diff = highlight_diff(diff_text)  # 高亮显示差异
 
     return highlighted_diff
 
+async def read_stream(stream, buffer):
+    """
+    持续读取子进程输出流并追加到缓冲区的异步函数，直到流结束。
+
+    参数:
+    stream (asyncio.StreamReader): 子进程的标准输出或标准错误流。
+    buffer (bytearray): 保存已读取内容的缓冲区。
+    """
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+
+async def reap_process(process_id, process):
+    """
+    等待后台进程结束并将其从running_processes中移除的异步函数，避免留下僵尸进程。
+
+    参数:
+    process_id (str): 进程ID。
+    process (asyncio.subprocess.Process): 进程对象。
+    """
+    await process.wait()
+    if running_processes.get(process_id) is process:
+        del running_processes[process_id]
+
 async def execute_code(code, timeout=10):
     """
     执行Python代码的异步函数。
@@ -752,98 +1403,164 @@ async def execute_code(code, timeout=10):
 
     调用的外部函数:
     - setup_virtual_environment(): 设置虚拟环境。
-    - asyncio.create_subprocess_shell(): 创建一个子进程来运行shell命令。
-    - asyncio.wait_for(): 等待一个协程完成，有超时限制。
+    - asyncio.create_subprocess_exec(): 创建一个子进程来运行Python解释器。
+    - read_stream(): 持续读取子进程的输出。
+    - asyncio.wait(): 等待进程结束，有超时限制，超时不会取消等待的任务。
     """
     global running_processes
     venv_path, activate_script = setup_virtual_environment()  # 设置虚拟环境
     
     # 生成此进程的唯一标识符
-    process_id = f"process_{len(running_processes)}"
+    process_id = f"process_{next(_process_counter)}"
     
-    # 将代码写入临时文件
-    with open(f"{process_id}.py", "w") as f:
-        f.write(code)
+    python_path = os.path.join(venv_path, _VENV_BIN, _PYTHON_NAME)
     
-    # 准备运行代码的命令
-    if sys.platform == "win32":
-        command = f'"{activate_script}" && python3 {process_id}.py'
-    else:
-        command = f'source "{activate_script}" && python3 {process_id}.py'
-    
-    # 创建一个进程来运行命令
-    process = await asyncio.create_subprocess_shell(
-        command,
+    # 创建一个进程来运行代码，代码通过标准输入管道传给"python -"，不再写入临时文件
+    process = await asyncio.create_subprocess_exec(
+        python_path,
+        "-",
+        stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        shell=True,
-        preexec_fn=None if sys.platform == "win32" else os.setsid
+        start_new_session=sys.platform != "win32"  # 新建会话以便stop_process终止整个进程组
     )
     
-    # 将进程存储在全局字典中
+    # 将进程存储在全局字典中，超出上限时终止最早启动的进程
     running_processes[process_id] = process
-    
+    while len(running_processes) > MAX_RUNNING_PROCESSES:
+        stop_process(next(iter(running_processes)))
+
+    # 读取任务独立于超时持续运行：超时后已读到的输出不会丢失，后台进程也不会因管道写满而阻塞
+    stdout_buffer, stderr_buffer = bytearray(), bytearray()
+    readers = [
+        asyncio.create_task(read_stream(process.stdout, stdout_buffer)),
+        asyncio.create_task(read_stream(process.stderr, stderr_buffer)),
+    ]
+
     try:
-        # 等待初始输出或超时
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-        stdout = stdout.decode()  # 解码标准输出
-        stderr = stderr.decode()  # 解码标准错误
+        process.stdin.write(code.encode())
+        await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # 进程已提前退出，错误信息会出现在标准错误中
+    finally:
+        process.stdin.close()
+
+    # 等待进程结束或超时，超时只停止等待，不取消读取任务
+    done, _ = await asyncio.wait([asyncio.create_task(process.wait())], timeout=timeout)
+    if done:
+        await asyncio.wait(readers, timeout=1)  # 读取进程退出前的剩余输出
+        stdout = stdout_buffer.decode(errors="replace")  # 解码标准输出
+        stderr = stderr_buffer.decode(errors="replace")  # 解码标准错误
         return_code = process.returncode  # 获取返回码
-    except asyncio.TimeoutError:
-        # 如果超时，表示进程仍在运行
-        stdout = "Process started and running in the background."
-        stderr = ""
+        running_processes.pop(process_id, None)  # 进程已结束，不再保留
+    else:
+        # 如果超时，表示进程仍在运行，返回目前为止的输出
+        stdout = "Process started and running in the background.\n" + stdout_buffer.decode(errors="replace")
+        stderr = stderr_buffer.decode(errors="replace")
         return_code = "Running"
+        # 进程自然结束后将其从running_processes中移除并回收
+        reaper = asyncio.create_task(reap_process(process_id, process))
+        _reaper_tasks.add(reaper)
+        reaper.add_done_callback(_reaper_tasks.discard)
     
     execution_result = f"Process ID: {process_id}\n\nStdout:\n{stdout}\n\nStderr:\n{stderr}\n\nReturn Code: {return_code}"
     return process_id, execution_result
 
-def read_file(path):
+async def read_file(path):
     """
-    读取指定路径文件内容的函数。
+    读取指定路径文件内容的异步函数，读取在线程池中进行，写入file_contents在事件循环线程中进行。
     
     参数:
     path (str): 文件路径。
     
     返回:
-    str: 读取结果信息。
+    tuple: 读取结果信息和已写入系统提示的文件路径列表。
 
     调用的外部函数:
-    - open(): 打开文件。
+    - asyncio.to_thread(): 在线程池中执行read_text_file()。
+    - read_text_file(): 读取文件内容。
     """
     global file_contents
     try:
-        with open(path, 'r') as f:
-            content = f.read()  # 读取文件内容
-        file_contents[path] = content  # 更新文件内容到全局字典
-        return f"File '{path}' has been read and stored in the system prompt."  # 返回成功信息
+        content = await asyncio.to_thread(read_text_file, path)  # 在线程池中读取文件内容
+        set_file_content(path, content)  # 更新文件内容到全局字典
+        return f"File '{path}' has been read and stored in the system prompt.{truncation_note(path)}", [path]  # 返回成功信息
     except Exception as e:
-        return f"Error reading file: {str(e)}"  # 返回错误信息
+        return f"Error reading file: {str(e)}", []  # 返回错误信息
 
-def read_multiple_files(paths):
+# 超过该大小的文件通过mmap读取
+MMAP_THRESHOLD = 1024 * 1024
+
+def read_text_file(path):
+    """
+    以尽量少的系统调用读取文本文件的函数：一次fstat获取大小，再按该大小一次性读取。
+
+    参数:
+    path (str): 文件路径。
+
+    返回:
+    str: 文件内容，换行符与open()的文本模式一致地统一为"\n"。
+
+    调用的外部函数:
+    - os.open(): 打开文件描述符。
+    - os.fstat(): 获取文件大小。
+    - os.read(): 读取文件内容。
+    - mmap.mmap(): 映射超过MMAP_THRESHOLD的大文件。
+    """
+    encoding = locale.getpreferredencoding(False)
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        st = os.fstat(fd)
+        size = st.st_size
+        if size > MMAP_THRESHOLD and stat.S_ISREG(st.st_mode):
+            # 大文件通过mmap直接从页缓存解码，省去一份中间bytes副本
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+                content = str(mm, encoding)
+            return content.replace("\r\n", "\n").replace("\r", "\n")
+        chunks = []
+        while True:
+            chunk = os.read(fd, max(size, 65536))  # 常规文件通常一次读完，再读一次确认到达文件末尾
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    content = b"".join(chunks).decode(encoding)
+    return content.replace("\r\n", "\n").replace("\r", "\n")
+
+async def read_multiple_files(paths, max_concurrency=32):
     """
-    读取多个文件内容的函数。
+    并发读取多个文件内容的异步函数，读取在线程池中进行，不阻塞事件循环。
     
     参数:
     paths (list): 文件路径列表。
+    max_concurrency (int): 同时读取的最大文件数。
     
     返回:
-    str: 读取结果信息。
+    tuple: 读取结果信息和已写入系统提示的文件路径列表。
 
     调用的外部函数:
-    - open(): 打开文件。
+    - asyncio.to_thread(): 在线程池中执行read_text_file()。
+    - read_text_file(): 读取文件内容。
     """
-    global file_contents
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def read_one(path):
+        async with semaphore:
+            return await asyncio.to_thread(read_text_file, path)
+
+    contents = await asyncio.gather(*(read_one(path) for path in paths), return_exceptions=True)
+
     results = []
-    for path in paths:
-        try:
-            with open(path, 'r') as f:
-                content = f.read()  # 读取文件内容
-            file_contents[path] = content  # 更新文件内容到全局字典
-            results.append(f"File '{path}' has been read and stored in the system prompt.")  # 返回成功信息
-        except Exception as e:
-            results.append(f"Error reading file '{path}': {str(e)}")  # 返回错误信息
-    return "\n".join(results)
+    updated_paths = []
+    for path, content in zip(paths, contents):
+        if isinstance(content, Exception):
+            results.append(f"Error reading file '{path}': {str(content)}")  # 返回错误信息
+        else:
+            set_file_content(path, content)  # 更新文件内容到全局字典
+            updated_paths.append(path)
+            results.append(f"File '{path}' has been read and stored in the system prompt.{truncation_note(path)}")  # 返回成功信息
+    return "\n".join(results), updated_paths
 
 
 def list_files(path="."):
@@ -857,17 +1574,28 @@ def list_files(path="."):
     str: 文件列表或错误信息。
 
     调用的外部函数:
-    - os.listdir(): 返回指定目录下的文件和子目录列表。
+    - os.stat(): 获取目录的修改时间，目录未变化时直接返回缓存的列表。
+    - os.scandir(): 迭代指定目录下的文件和子目录。
     """
     try:
-        files = os.listdir(path)  # 列出指定路径下的所有文件
-        return "\n".join(files)  # 返回文件列表
+        key = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns  # 目录中增删文件会更新目录的修改时间
+        cached = _listdir_cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]  # 目录未变化，返回缓存的文件列表
+        with os.scandir(path) as entries:  # 列出指定路径下的所有文件，迭代器用完后立即关闭目录句柄
+            listing = "\n".join(entry.name for entry in entries)
+        if time.time_ns() - mtime >= LISTDIR_RACY_NS:
+            _listdir_cache[key] = (mtime, listing)
+        else:
+            _listdir_cache.pop(key, None)  # 刚修改过的目录在同一时间戳内可能还会变化，不缓存
+        return listing  # 返回文件列表
     except Exception as e:
         return f"Error listing files: {str(e)}"  # 返回错误信息
 
-def tavily_search(query):
+async def tavily_search(query):
     """
-    使用Tavily API进行搜索的函数。
+    使用Tavily API进行搜索的异步函数。
     
     参数:
     query (str): 搜索查询。
@@ -876,11 +1604,18 @@ def tavily_search(query):
     str: 搜索结果或错误信息。
 
     调用的外部函数:
-    - tavily.qna_search(): 使用Tavily API进行问答搜索。
+    - get_tavily_http(): 获取访问Tavily API的HTTP客户端。
     """
     try:
-        response = tavily.qna_search(query=query, search_depth="advanced")  # 使用Tavily API进行搜索
-        return response  # 返回搜索结果
+        # 与tavily-python的qna_search相同的参数：高级搜索并只返回生成的答案
+        response = await get_tavily_http().post(TAVILY_SEARCH_URL, json={
+            "query": query,
+            "search_depth": "advanced",
+            "include_answer": True,
+            "max_results": 5,
+        })
+        response.raise_for_status()
+        return response.json().get("answer", "")  # 返回搜索结果
     except Exception as e:
         return f"Error performing search: {str(e)}"  # 返回错误信息
 
@@ -899,12 +1634,14 @@ def stop_process(process_id):
     """
     global running_processes
     if process_id in running_processes:
-        process = running_processes[process_id]  # 获取进程
-        if sys.platform == "win32":
-            process.terminate()  # 终止进程
-        else:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)  # 发送终止信号
-        del running_processes[process_id]  # 从全局字典中删除进程
+        process = running_processes.pop(process_id)  # 从全局字典中取出进程
+        try:
+            if sys.platform == "win32":
+                process.terminate()  # 终止进程
+            else:
+                os.killpg(os.getpgid(process.pid), signal.SIGTERM)  # 发送终止信号
+        except ProcessLookupError:
+            pass  # 进程已经结束，尚未被回收
         return f"Process {process_id} has been stopped."  # 返回成功信息
     else:
         return f"No running process found with ID {process_id}."  # 返回错误信息
@@ -1072,7 +1809,63 @@ tools = [
     }
 ]
 
-from typing import Dict, Any
+# 只读的工具，同一轮中连续的这些工具调用可以并发执行
+PARALLEL_SAFE_TOOLS = {"read_file", "read_multiple_files", "list_files", "tavily_search"}
+
+# tools是静态的，只在导入时序列化一次，并预先构建放入系统提示的内容块
+TOOLS_JSON = jdumps(tools)
+TOOLS_JSON_BLOCK = {"type": "text", "text": TOOLS_JSON, "cache_control": {"type": "ephemeral"}}
+TOOLS_JSON_TOKENS = count_tokens(TOOLS_JSON)
+
+async def _tool_create_files(tool_input):
+    # 处理单个文件和多个文件的情况
+    result, updated_paths = create_files(tool_input.get("files", [tool_input]))  # 创建文件
+    return result, None, updated_paths
+
+async def _tool_edit_and_apply_multiple(tool_input):
+    return await edit_and_apply_multiple(tool_input["files"], tool_input["project_context"], is_automode=automode)  # 编辑并应用多个文件
+
+async def _tool_create_folders(tool_input):
+    return create_folders(tool_input["paths"]), None, ()  # 创建文件夹
+
+async def _tool_read_file(tool_input):
+    result, updated_paths = await read_file(tool_input["path"])  # 读取文件
+    return result, None, updated_paths
+
+async def _tool_read_multiple_files(tool_input):
+    result, updated_paths = await read_multiple_files(tool_input["paths"])  # 读取多个文件
+    return result, None, updated_paths
+
+async def _tool_list_files(tool_input):
+    return await asyncio.to_thread(list_files, tool_input.get("path", ".")), None, ()  # 在线程池中列出文件
+
+async def _tool_tavily_search(tool_input):
+    return await tavily_search(tool_input["query"]), None, ()  # 执行网络搜索
+
+async def _tool_stop_process(tool_input):
+    return stop_process(tool_input["process_id"]), None, ()  # 停止进程
+
+async def _tool_execute_code(tool_input):
+    process_id, execution_result = await execute_code(tool_input["code"])  # 执行代码
+    analysis = await send_to_ai_for_executing(tool_input["code"], execution_result)  # 发送执行结果进行分析
+    result = f"{execution_result}\n\nAnalysis:\n{analysis}"  # 返回执行结果和分析
+    if process_id in running_processes:
+        result += "\n\nNote: The process is still running in the background."  # 进程仍在运行的提示
+    return result, None, ()
+
+# 工具名称到处理函数的映射，每个处理函数接收tool_input并返回(result, console_output, updated_paths)，
+# updated_paths是本次调用写入系统提示的文件路径
+TOOL_HANDLERS = {
+    "create_files": _tool_create_files,
+    "edit_and_apply_multiple": _tool_edit_and_apply_multiple,
+    "create_folders": _tool_create_folders,
+    "read_file": _tool_read_file,
+    "read_multiple_files": _tool_read_multiple_files,
+    "list_files": _tool_list_files,
+    "tavily_search": _tool_tavily_search,
+    "stop_process": _tool_stop_process,
+    "execute_code": _tool_execute_code,
+}
 
 async def execute_tool(tool_name: str, tool_input: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -1083,75 +1876,80 @@ async def execute_tool(tool_name: str, tool_input: Dict[str, Any]) -> Dict[str,
     tool_input (dict): 工具输入参数。
     
     返回:
-    dict: 包含工具执行结果的字典。
+    dict: 包含工具执行结果的字典，meta["updated_paths"]为写入系统提示的文件路径。
 
     调用的外部函数:
-    - create_files(): 创建文件。
-    - edit_and_apply_multiple(): 编辑并应用多个文件的更改。
-    - create_folders(): 创建文件夹。
-    - read_file(): 读取文件内容。
-    - read_multiple_files(): 读取多个文件的内容。
-    - list_files(): 列出指定目录下的文件和文件夹。
-    - tavily_search(): 执行网络搜索。
-    - stop_process(): 停止指定的进程。
-    - execute_code(): 执行代码并返回结果。
-    - send_to_ai_for_executing(): 发送代码执行结果给AI进行分析。
+    - TOOL_HANDLERS中对应工具的处理函数。
     - logging.error(): 记录错误日志。
     """
     try:
         result = None
         is_error = False
         console_output = None
+        updated_paths = ()
 
-        if tool_name == "create_files":
-            # 处理单个文件和多个文件的情况
-            files = tool_input.get("files", [tool_input])
-            result = create_files(files)  # 创建文件
-        elif tool_name == "edit_and_apply_multiple":
-            result, console_output = await edit_and_apply_multiple(tool_input["files"], tool_input["project_context"], is_automode=automode)  # 编辑并应用多个文件
-        elif tool_name == "create_folders":
-            result = create_folders(tool_input["paths"])  # 创建文件夹
-        elif tool_name == "read_file":
-            result = read_file(tool_input["path"])  # 读取文件
-        elif tool_name == "read_multiple_files":
-            result = read_multiple_files(tool_input["paths"])  # 读取多个文件
-        elif tool_name == "list_files":
-            result = list_files(tool_input.get("path", "."))  # 列出文件
-        elif tool_name == "tavily_search":
-            result = tavily_search(tool_input["query"])  # 执行搜索
-        elif tool_name == "stop_process":
-            result = stop_process(tool_input["process_id"])  # 停止进程
-        elif tool_name == "execute_code":
-            process_id, execution_result = await execute_code(tool_input["code"])  # 执行代码
-            analysis_task = asyncio.create_task(send_to_ai_for_executing(tool_input["code"], execution_result))  # 发送执行结果进行分析
-            analysis = await analysis_task
-            result = f"{execution_result}\n\nAnalysis:\n{analysis}"  # 返回执行结果和分析
-            if process_id in running_processes:
-                result += "\n\nNote: The process is still running in the background."  # 进程仍在运行的提示
-        else:
+        handler = TOOL_HANDLERS.get(tool_name)
+        if handler is None:
             is_error = True
             result = f"Unknown tool: {tool_name}"  # 未知工具的错误信息
+        else:
+            result, console_output, updated_paths = await handler(tool_input)
 
         return {
             "content": result,
             "is_error": is_error,
-            "console_output": console_output
+            "console_output": console_output,
+            "meta": {"updated_paths": updated_paths}
         }
     except KeyError as e:
         logging.error(f"Missing required parameter {str(e)} for tool {tool_name}")  # 记录缺少参数的错误
         return {
             "content": f"Error: Missing required parameter {str(e)} for tool {tool_name}",
             "is_error": True,
-            "console_output": None
+            "console_output": None,
+            "meta": {"updated_paths": ()}
         }
     except Exception as e:
         logging.error(f"Error executing tool {tool_name}: {str(e)}")  # 记录执行工具的错误
         return {
             "content": f"Error executing tool {tool_name}: {str(e)}",
             "is_error": True,
-            "console_output": None
+            "console_output": None,
+            "meta": {"updated_paths": ()}
         }
 
+async def execute_tool_uses(tool_uses):
+    """
+    执行一轮响应中的所有工具调用的异步函数。连续的只读工具调用并发执行，
+    其他工具调用按顺序执行，保证写操作和之后的读操作的先后顺序不变。
+
+    参数:
+    tool_uses (list): 响应中的tool_use块列表。
+
+    返回:
+    list: 与tool_uses顺序一致的工具执行结果列表。
+
+    调用的外部函数:
+    - execute_tool(): 执行指定的工具。
+    - asyncio.gather(): 并发执行多个只读工具调用。
+    """
+    results = []
+    batch = []  # 尚未执行的连续只读工具调用
+    for tool_use in tool_uses:
+        if tool_use.name in PARALLEL_SAFE_TOOLS:
+            batch.append(tool_use)
+            continue
+        if batch:
+            results.extend(await asyncio.gather(*(execute_tool(t.name, t.input) for t in batch)))
+            batch = []
+        results.append(await execute_tool(tool_use.name, tool_use.input))
+    if batch:
+        results.extend(await asyncio.gather(*(execute_tool(t.name, t.input) for t in batch)))
+    return results
+
+# 小于该字节数且尺寸不超限的RGB JPEG直接发送原始文件，不重新编码
+SMALL_JPEG_PASSTHROUGH_BYTES = 200 * 1024
+
 def encode_image_to_base64(image_path):
     """
     将图像文件编码为Base64格式的函数。
@@ -1163,21 +1961,33 @@ def encode_image_to_base64(image_path):
     str: 图像的Base64编码或错误信息。
 
     调用的外部函数:
-    - Image.open(): 打开图像文件。
+    - Image.open(): 打开图像文件（小JPEG只读取文件头以检查尺寸）。
+    - Image.draft(): 按缩小的比例解码JPEG图像。
     - Image.thumbnail(): 调整图像大小。
     - Image.convert(): 转换图像模式。
     - io.BytesIO(): 创建字节流对象。
     - base64.b64encode(): 将二进制数据编码为Base64格式。
     """
+    from PIL import Image  # 只在处理图像时才导入PIL
+
     try:
+        max_size = (1024, 1024)  # 设置最大尺寸
+        with open(image_path, 'rb') as f:
+            raw = f.read(SMALL_JPEG_PASSTHROUGH_BYTES + 1)
+        # 已经足够小的RGB JPEG无需解码再重新编码，直接发送原始字节
+        if raw.startswith(b'\xff\xd8\xff') and len(raw) <= SMALL_JPEG_PASSTHROUGH_BYTES:
+            with Image.open(io.BytesIO(raw)) as img:  # 只解析文件头，不解码像素
+                if img.mode == 'RGB' and img.width <= max_size[0] and img.height <= max_size[1]:
+                    return base64.b64encode(raw).decode('utf-8')
+
         with Image.open(image_path) as img:  # 打开图像文件
-            max_size = (1024, 1024)  # 设置最大尺寸
-            img.thumbnail(max_size, Image.DEFAULT_STRATEGY)  # 调整图像大小
+            img.draft('RGB', max_size)  # 对JPEG让libjpeg直接按缩小的比例解码
+            img.thumbnail(max_size, Image.Resampling.LANCZOS)  # 调整图像大小
             if img.mode != 'RGB':
                 img = img.convert('RGB')  # 转换为RGB模式
             img_byte_arr = io.BytesIO()  # 创建字节流
-            img.save(img_byte_arr, format='JPEG')  # 保存图像为JPEG格式
-            return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')  # 返回图像的Base64编码
+            img.save(img_byte_arr, format='JPEG', quality=85, optimize=False, progressive=False, subsampling=2)  # 保存图像为JPEG格式
+            return base64.b64encode(img_byte_arr.getbuffer()).decode('utf-8')  # 直接编码缓冲区，避免getvalue()复制
     except Exception as e:
         return f"Error encoding image: {str(e)}"  # 返回编码图像的错误信息
 
@@ -1220,7 +2030,7 @@ async def send_to_ai_for_executing(code, execution_result):
         IMPORTANT: PROVIDE ONLY YOUR ANALYSIS AND OBSERVATIONS. DO NOT INCLUDE ANY PREFACING STATEMENTS OR EXPLANATIONS OF YOUR ROLE.
         """
 
-        response = client.beta.prompt_caching.messages.create(
+        response = await client.beta.prompt_caching.messages.create(
             model=CODEEXECUTIONMODEL,
             max_tokens=2000,
             system=[
@@ -1237,10 +2047,7 @@ async def send_to_ai_for_executing(code, execution_result):
         )
 
         # 更新代码执行的token使用情况
-        code_execution_tokens['input'] += response.usage.input_tokens
-        code_execution_tokens['output'] += response.usage.output_tokens
-        code_execution_tokens['cache_creation'] = response.usage.cache_creation_input_tokens
-        code_execution_tokens['cache_read'] = response.usage.cache_read_input_tokens
+        record_usage(code_execution_tokens, "Code Execution", response.usage)
 
         analysis = response.content[0].text  # 获取分析结果
 
@@ -1262,7 +2069,7 @@ def save_chat(format):
 
     调用的外部函数:
     - datetime.now(): 获取当前日期和时间。
-    - json.dump(): 将Python对象序列化为JSON格式。
+    - jdumps(): 将Python对象序列化为JSON格式。
     """
     # 生成文件名
     now = datetime.datetime.now()
@@ -1270,31 +2077,31 @@ def save_chat(format):
     
     if format == 'markdown':
         # 将对话历史格式化为Markdown
-        formatted_chat = "# Claude-3-Sonnet Engineer Chat Log\n\n"
+        parts = ["# Claude-3-Sonnet Engineer Chat Log\n\n"]  # 先收集片段，最后一次性拼接，避免字符串反复+=
         for message in conversation_history:
             if message['role'] == 'user':
-                formatted_chat += f"## User\n\n{message['content']}\n\n"
+                parts.append(f"## User\n\n{message['content']}\n\n")
             elif message['role'] == 'assistant':
                 if isinstance(message['content'], str):
-                    formatted_chat += f"## Claude\n\n{message['content']}\n\n"
+                    parts.append(f"## Claude\n\n{message['content']}\n\n")
                 elif isinstance(message['content'], list):
                     for content in message['content']:
                         if content['type'] == 'tool_use':
-                            formatted_chat += f"### Tool Use: {content['name']}\n\n```json\n{json.dumps(content['input'], indent=2)}\n```\n\n"
+                            parts.append(f"### Tool Use: {content['name']}\n\n```json\n{jdumps(content['input'], indent=True)}\n```\n\n")
                         elif content['type'] == 'text':
-                            formatted_chat += f"## Claude\n\n{content['text']}\n\n"
+                            parts.append(f"## Claude\n\n{content['text']}\n\n")
             elif message['role'] == 'user' and isinstance(message['content'], list):
                 for content in message['content']:
                     if content['type'] == 'tool_result':
-                        formatted_chat += f"### Tool Result\n\n```\n{content['content']}\n```\n\n"
+                        parts.append(f"### Tool Result\n\n```\n{content['content']}\n```\n\n")
 
         # 保存到文件
         with open(filename, 'w', encoding='utf-8') as f:
-            f.write(formatted_chat)
+            f.write("".join(parts))
     else:
         # 保存为JSON格式
         with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(conversation_history, f, indent=2, ensure_ascii=False)
+            f.write(jdumps(list(conversation_history), indent=True))
     
     return filename
 
@@ -1309,30 +2116,32 @@ def load_chat(filename):
     bool: 加载是否成功。
 
     调用的外部函数:
-    - json.load(): 从JSON文件中加载数据。
+    - jloads(): 从JSON文件内容中解析数据。
     - console.print(): 打印控制台信息。
     - display_token_usage(): 显示token使用情况。
     """
-    global conversation_history, main_model_tokens, tool_checker_tokens, code_editor_tokens, code_execution_tokens
+    global conversation_history, durable_conversation_history, main_model_tokens, tool_checker_tokens, code_editor_tokens, code_execution_tokens, token_totals
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            loaded_data = json.load(f)  # 加载聊天记录
+        with open(filename, 'rb') as f:
+            loaded_data = jloads(f.read())  # 加载聊天记录
 
         # 验证加载的数据结构
         if not isinstance(loaded_data, list) or not all(isinstance(item, dict) for item in loaded_data):
             raise ValueError("Invalid chat file format")  # 抛出格式错误
 
-        conversation_history = loaded_data  # 更新对话历史
+        conversation_history = BoundedHistory(loaded_data)  # 更新对话历史
+        durable_conversation_history = BoundedHistory(loaded_data)
 
         # 重置token计数
-        main_model_tokens = {'input': 0, 'output': 0}
-        tool_checker_tokens = {'input': 0, 'output': 0}
-        code_editor_tokens = {'input': 0, 'output': 0}
-        code_execution_tokens = {'input': 0, 'output': 0}
+        main_model_tokens = TokenStats()
+        tool_checker_tokens = TokenStats()
+        code_editor_tokens = TokenStats()
+        code_execution_tokens = TokenStats()
+        token_totals = TokenStats()
 
         console.print(Panel(f"Chat loaded from {filename}", title="Chat Loaded", style="bold green"))  # 显示加载成功信息
         console.print(Panel("Token usage information will be recalculated.", title="Recalculation", style="bold yellow"))  # 显示token信息将被重新计算
-        display_token_usage()  # 显示token使用情况
+        display_token_usage(force=True)  # 显示token使用情况
         return True
     except FileNotFoundError:
         console.print(Panel(f"File not found: {filename}", title="Error", style="bold red"))  # 显示文件未找到错误
@@ -1342,6 +2151,78 @@ def load_chat(filename):
         console.print(Panel(f"Error loading chat: {str(e)}", title="Error", style="bold red"))  # 显示加载错误
     return False
 
+def recent_history(k=HISTORY_SEND_WINDOW):
+    """
+    获取持久对话历史中最近的k条消息，跳过开头不是用户输入的消息，以保证对话从用户输入开始。
+
+    参数:
+    k (int): 消息条数。
+
+    返回:
+    tuple: (消息列表, 对应的估计token数列表, 对应的标志位列表)。
+
+    调用的外部函数:
+    - BoundedHistory.recent(): 按列获取最近的消息、token数和标志位。
+    """
+    messages, tokens, flags = durable_conversation_history.recent(k)
+    start = next((i for i, flag in enumerate(flags) if flag & MSG_USER_TURN_START), len(flags))
+    return messages[start:], tokens[start:], flags[start:]
+
+def fit_history_to_context(history, history_tokens, history_flags, system_tokens, current, budget=None):
+    """
+    从history开头按完整的对话轮次丢弃消息，直到请求的估计token数不超过预算。
+    当前对话current永远保留。
+
+    参数:
+    history (list): 以用户输入开始的历史消息。
+    history_tokens (list): 与history一一对应的估计token数。
+    history_flags (list): 与history一一对应的MSG_*标志位。
+    system_tokens (int): 系统提示的估计token数。
+    current (list): 当前轮次的消息。
+    budget (Optional[int]): token预算，默认为MAX_CONTEXT_TOKENS减去为输出保留的token数。
+
+    返回:
+    tuple: 裁剪后的历史消息、对应的token数、对应的标志位和请求的估计token数。
+    """
+    if budget is None:
+        budget = MAX_CONTEXT_TOKENS - CONTEXT_OUTPUT_RESERVE
+    total = request_tokens(system_tokens, current) + sum(history_tokens)
+    start = 0
+    while total > budget and start < len(history):
+        # 丢弃一整轮：用户输入及其后直到下一条用户输入之前的所有消息
+        total -= history_tokens[start]
+        start += 1
+        while start < len(history) and not history_flags[start] & MSG_USER_TURN_START:
+            total -= history_tokens[start]
+            start += 1
+    return history[start:], history_tokens[start:], history_flags[start:], total
+
+def append_history(message, ephemeral=False):
+    """
+    将消息追加到对话历史。
+
+    参数:
+    message (dict): 对话消息。
+    ephemeral (bool): 为True时只记录到conversation_history，不写入发送给模型的持久对话历史。
+    """
+    conversation_history.append(message)
+    if not ephemeral:
+        durable_conversation_history.append(message)
+
+def is_tool_result_message(message):
+    """
+    判断消息是否是包含tool_result的用户消息。
+
+    参数:
+    message (dict): 对话消息。
+
+    返回:
+    bool: 是否包含tool_result。
+    """
+    return message['role'] == 'user' and isinstance(message['content'], list) and any(
+        content.get('type') == 'tool_result' for content in message['content']
+    )
+
 async def chat_with_claude(user_input, image_path=None, current_iteration=None, max_iterations=None):
     """
     与Claude进行对话的异步函数。
@@ -1357,20 +2238,21 @@ async def chat_with_claude(user_input, image_path=None, current_iteration=None,
 
     调用的外部函数:
     - encode_image_to_base64(): 将图像编码为Base64格式。
+    - recent_history(): 获取最近的对话历史。
     - update_system_prompt(): 更新系统提示。
-    - json.dumps(): 将Python对象转换为JSON字符串。
-    - client.beta.prompt_caching.messages.create(): 创建一个新的AI消息。
-    - execute_tool(): 执行指定的工具。
+    - client.beta.prompt_caching.messages.stream(): 以流式方式创建一个新的AI消息。
+    - execute_tool_uses(): 执行响应中的所有工具调用。
     - console.print(): 打印控制台信息。
     - display_token_usage(): 显示token使用情况。
     """
     global conversation_history, automode, main_model_tokens
 
     current_conversation = []  # 当前对话记录
+    ephemeral_flags = []  # 与current_conversation一一对应，标记不写入持久对话历史的消息
 
     if image_path:
         console.print(Panel(f"Processing image at path: {image_path}", title_align="left", title="Image Processing", expand=False, style="yellow"))  # 显示图像处理信息
-        image_base64 = encode_image_to_base64(image_path)  # 将图像编码为Base64
+        image_base64 = await asyncio.to_thread(encode_image_to_base64, image_path)  # 在线程池中将图像编码为Base64
 
         if image_base64.startswith("Error"):
             console.print(Panel(f"Error encoding image: {image_base64}", title="Error", style="bold red"))  # 显示编码错误
@@ -1394,64 +2276,47 @@ async def chat_with_claude(user_input, image_path=None, current_iteration=None,
             ]
         }
         current_conversation.append(image_message)  # 添加图像消息到当前对话
+        ephemeral_flags.append(False)
         console.print(Panel("Image message added to conversation history", title_align="left", title="Image Added", style="green"))  # 显示图像已添加信息
     else:
         current_conversation.append({"role": "user", "content": user_input})  # 添加用户输入到当前对话
+        ephemeral_flags.append(False)
 
-    # 过滤对话历史以维护上下文
-    filtered_conversation_history = []
-    for message in conversation_history:
-        if isinstance(message['content'], list):
-            filtered_content = [
-                content for content in message['content']
-                if content.get('type') != 'tool_result' or (
-                    content.get('type') == 'tool_result' and
-                    not any(keyword in content.get('output', '') for keyword in [
-                        "File contents updated in system prompt",
-                        "File created and added to system prompt",
-                        "has been read and stored in the system prompt"
-                    ])
-                )
-            ]
-            if filtered_content:
-                filtered_conversation_history.append({**message, 'content': filtered_content})  # 添加过滤后的消息
-        else:
-            filtered_conversation_history.append(message)  # 添加非列表消息
+    # 持久对话历史在写入时已去掉只用于加载文件内容的工具调用，这里无需再逐条过滤
+    # 截取窗口后历史可能以助手消息或tool_result开头，recent_history()会跳过它们以保证对话从用户输入开始
+    filtered_conversation_history, history_tokens, history_flags = recent_history()
+
+    system_blocks = update_system_prompt(current_iteration, max_iterations) + [TOOLS_JSON_BLOCK]  # 更新系统提示
+    # 发送前估计token数，超出上下文窗口时丢弃最早的对话轮次
+    system_tokens = system_prompt_tokens() + TOOLS_JSON_TOKENS  # 系统提示中还附带了一份工具定义
+    history, history_tokens, history_flags, input_tokens = fit_history_to_context(filtered_conversation_history, history_tokens, history_flags, system_tokens, current_conversation)
 
-    # 将过滤后的历史与当前对话结合以维护上下文
-    messages = filtered_conversation_history + current_conversation
+    # 将过滤后的历史与当前对话结合以维护上下文；之后的工具调用消息直接追加到messages，不再每轮重新拼接整个列表
+    messages = history + current_conversation
 
     try:
-        # MAINMODEL调用，使用提示缓存
-        response = client.beta.prompt_caching.messages.create(
+        await rate_limiter.acquire(input_tokens)  # 按限额主动等待，避免触发429
+        # MAINMODEL调用，使用提示缓存；以流式方式接收，文本一到达就打印，不必等待完整生成
+        async with client.beta.prompt_caching.messages.stream(
             model=MAINMODEL,
             max_tokens=4096,
-            system=[
-                {
-                    "type": "text",
-                    "text": update_system_prompt(current_iteration, max_iterations),  # 更新系统提示
-                    "cache_control": {"type": "ephemeral"}
-                },
-                {
-                    "type": "text",
-                    "text": json.dumps(tools),  # 将工具信息转换为JSON格式
-                    "cache_control": {"type": "ephemeral"}
-                }
-            ],
+            system=system_blocks,
             messages=messages,  # 发送的消息
             tools=tools,  # 可用工具
             tool_choice={"type": "auto"},  # 自动选择工具
             extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"}
-        )
+        ) as stream:
+            console.rule("[bold blue]Claude's Response", align="left", style="blue")
+            async for text in stream.text_stream:
+                console.print(text, end="", markup=False, highlight=False)  # 逐段打印助手响应
+            console.print()
+            response = await stream.get_final_message()
         # 更新MAINMODEL的token使用情况
-        main_model_tokens['input'] += response.usage.input_tokens
-        main_model_tokens['output'] += response.usage.output_tokens
-        main_model_tokens['cache_creation'] = response.usage.cache_creation_input_tokens
-        main_model_tokens['cache_read'] = response.usage.cache_read_input_tokens
+        record_usage(main_model_tokens, "Main Model", response.usage)
     except APIStatusError as e:
         if e.status_code == 429:
             console.print(Panel("Rate limit exceeded. Retrying after a short delay...", title="API Error", style="bold yellow"))  # 显示速率限制错误
-            time.sleep(5)  # 等待5秒后重试
+            await asyncio.sleep(5)  # 等待5秒后重试，不阻塞事件循环
             return await chat_with_claude(user_input, image_path, current_iteration, max_iterations)
         else:
             console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))  # 显示API错误
@@ -1472,8 +2337,6 @@ async def chat_with_claude(user_input, image_path=None, current_iteration=None,
         elif content_block.type == "tool_use":
             tool_uses.append(content_block)  # 添加工具使用记录
 
-    console.print(Panel(Markdown(assistant_response), title="Claude's Response", title_align="left", border_style="blue", expand=False))  # 显示助手响应
-
     # 显示上下文中的文件
     if file_contents:
         files_in_context = "\n".join(file_contents.keys())  # 获取上下文中的文件列表
@@ -1481,98 +2344,111 @@ async def chat_with_claude(user_input, image_path=None, current_iteration=None,
         files_in_context = "No files in context. Read, create, or edit files to add."  # 没有文件的提示
     console.print(Panel(files_in_context, title="Files in Context", title_align="left", border_style="white", expand=False))  # 显示上下文文件
 
-    for tool_use in tool_uses:
+    tool_results = await execute_tool_uses(tool_uses)  # 执行工具，连续的只读工具并发执行
+
+    tool_use_blocks = []  # 本轮所有工具调用，合并为一条助手消息
+    tool_result_blocks = []  # 本轮所有工具结果，合并为一条用户消息
+    ephemeral = True  # 本轮所有工具调用都只用于加载文件内容时才不写入持久对话历史
+    panels = []  # 本轮所有工具调用的面板，最后合并为一个Group一次输出
+    for tool_use, tool_result in zip(tool_uses, tool_results):
         tool_name = tool_use.name  # 获取工具名称
         tool_input = tool_use.input  # 获取工具输入
         tool_use_id = tool_use.id  # 获取工具使用ID
 
-        console.print(Panel(f"Tool Used: {tool_name}", style="green"))  # 显示使用的工具
-        console.print(Panel(f"Tool Input: {json.dumps(tool_input, indent=2)}", style="green"))  # 显示工具输入
-
-        tool_result = await execute_tool(tool_name, tool_input)  # 执行工具
-        
+        panels.append(Panel(f"Tool Used: {tool_name}", style="green"))  # 显示使用的工具
+        if VERBOSE:
+            panels.append(Panel(f"Tool Input: {jdumps(tool_input, indent=True)}", style="green"))  # 显示工具输入
         if tool_result["is_error"]:
-            console.print(Panel(tool_result["content"], title="Tool Execution Error", style="bold red"))  # 显示工具执行错误
+            panels.append(Panel(tool_result["content"], title="Tool Execution Error", style="bold red"))  # 显示工具执行错误
         else:
-            console.print(Panel(tool_result["content"], title_align="left", title="Tool Result", style="green"))  # 显示工具结果
+            panels.append(Panel(tool_result["content"], title_align="left", title="Tool Result", style="green"))  # 显示工具结果
 
-        current_conversation.append({
-            "role": "assistant",
-            "content": [
-                {
-                    "type": "tool_use",
-                    "id": tool_use_id,
-                    "name": tool_name,
-                    "input": tool_input
-                }
-            ]
+        tool_use_blocks.append({
+            "type": "tool_use",
+            "id": tool_use_id,
+            "name": tool_name,
+            "input": tool_input
         })
-
-        current_conversation.append({
-            "role": "user",
-            "content": [
-                {
-                    "type": "tool_result",
-                    "tool_use_id": tool_use_id,
-                    "content": tool_result["content"],
-                    "is_error": tool_result["is_error"]
-                }
-            ]
+        tool_result_blocks.append({
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": tool_result["content"],
+            "is_error": tool_result["is_error"]
         })
 
-        # 如果适用，更新file_contents字典
-        if tool_name in ['create_files', 'edit_and_apply_multiple', 'read_file', 'read_multiple_files'] and not tool_result["is_error"]:
-            if tool_name == 'create_files':
-                for file in tool_input['files']:
-                    if "File created and added to system prompt" in tool_result["content"]:
-                        file_contents[file['path']] = file['content']  # 更新文件内容
-            elif tool_name == 'edit_and_apply_multiple':
-                for file in tool_input['files']:
-                    if f"Changes applied to {file['path']}" in tool_result["content"]:
-                        # file_contents字典已在edit_and_apply_multiple函数中更新
-                        pass
-            elif tool_name == 'read_file':
-                if "has been read and stored in the system prompt" in tool_result["content"]:
-                    # file_contents字典已在read_file函数中更新
-                    pass
-            elif tool_name == 'read_multiple_files':
-                # file_contents字典已在read_multiple_files函数中更新
-                pass
-
-        messages = filtered_conversation_history + current_conversation  # 更新消息记录
-
-        try:
-            tool_response = client.messages.create(
-                model=TOOLCHECKERMODEL,
-                max_tokens=4096,
-                system=update_system_prompt(current_iteration, max_iterations),  # 更新系统提示
-                extra_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
-                messages=messages,  # 发送的消息
-                tools=tools,  # 可用工具
-                tool_choice={"type": "auto"}  # 自动选择工具
-            )
-            # 更新工具检查器的token使用情况
-            tool_checker_tokens['input'] += tool_response.usage.input_tokens
-            tool_checker_tokens['output'] += tool_response.usage.output_tokens
-
-            tool_checker_response = ""  # 初始化工具检查器响应
-            for tool_content_block in tool_response.content:
-                if tool_content_block.type == "text":
-                    tool_checker_response += tool_content_block.text  # 添加工具检查器响应文本
-            console.print(Panel(Markdown(tool_checker_response), title="Claude's Response to Tool Result",  title_align="left", border_style="blue", expand=False))  # 显示工具检查器响应
-            assistant_response += "\n\n" + tool_checker_response  # 添加工具检查器响应到助手响应
-        except APIError as e:
-            error_message = f"Error in tool response: {str(e)}"  # 记录工具响应错误
-            console.print(Panel(error_message, title="Error", style="bold red"))  # 显示错误信息
-            assistant_response += f"\n\n{error_message}"  # 添加错误信息到助手响应
-
-    if assistant_response:
-        current_conversation.append({"role": "assistant", "content": assistant_response})  # 添加助手响应到当前对话
-
-    conversation_history = messages + [{"role": "assistant", "content": assistant_response}]  # 更新对话历史
+        # 文件内容已由各工具函数写入file_contents，这里只根据返回的updated_paths判断
+        ephemeral = ephemeral and tool_name in EPHEMERAL_TOOLS and not tool_result["is_error"] and bool(tool_result["meta"]["updated_paths"])
 
-    # 显示token使用情况
-    display_token_usage()
+    if tool_uses:
+        console.print(Group(*panels))  # 本轮所有工具面板只渲染和输出一次
+        panels = []  # 之后收集本轮结束时要输出的内容
+        tool_messages = (
+            {"role": "assistant", "content": tool_use_blocks},
+            {"role": "user", "content": tool_result_blocks}
+        )
+        current_conversation.extend(tool_messages)
+        messages.extend(tool_messages)  # 更新消息记录
+        # 在写入时标记只用于加载文件内容的工具调用，tool_use和tool_result成对跳过以保持消息配对
+        ephemeral_flags.extend((ephemeral, ephemeral))
+
+        # 自动模式的多次迭代中常出现完全相同的工具调用和结果，命中缓存时直接复用响应，不再请求API
+        cache_key = tool_checker_cache_key(tool_use_blocks, tool_result_blocks) if current_iteration is not None else None
+        cached_response = get_cached_tool_checker_response(cache_key) if cache_key is not None else None
+        if cached_response is not None:
+            console.rule("[bold blue]Claude's Response to Tool Result (cached)", align="left", style="blue")
+            console.print(cached_response, markup=False, highlight=False)
+            if CONTINUATION_EXIT_PHRASE in cached_response:
+                exit_continuation = True
+            assistant_response += "\n\n" + cached_response
+        else:
+            try:
+                # 本轮所有工具结果只发送一次TOOLCHECKERMODEL调用，使用提示缓存；在最后一条消息上设置断点，下一轮可复用整段对话前缀
+                # 以流式方式接收，文本一到达就打印
+                system_blocks = update_system_prompt(current_iteration, max_iterations)  # 更新系统提示
+                # 工具结果可能很大，再次检查上下文预算；messages始终等于history + current_conversation
+                trimmed_history, history_tokens, history_flags, input_tokens = fit_history_to_context(history, history_tokens, history_flags, system_prompt_tokens(), current_conversation)
+                if len(trimmed_history) < len(history):
+                    history = trimmed_history
+                    messages = history + current_conversation
+                await rate_limiter.acquire(input_tokens)  # 按限额主动等待，避免触发429
+                async with client.beta.prompt_caching.messages.stream(
+                    model=TOOLCHECKERMODEL,
+                    max_tokens=4096,
+                    system=system_blocks,
+                    extra_headers={"anthropic-beta": "prompt-caching-2024-07-31,max-tokens-3-5-sonnet-2024-07-15"},
+                    messages=with_cache_breakpoint(messages),  # 发送的消息
+                    tools=tools,  # 可用工具
+                    tool_choice={"type": "auto"}  # 自动选择工具
+                ) as stream:
+                    console.rule("[bold blue]Claude's Response to Tool Result", align="left", style="blue")
+                    tool_checker_parts = []
+                    async for text in stream.text_stream:
+                        console.print(text, end="", markup=False, highlight=False)  # 逐段打印工具检查器响应
+                        tool_checker_parts.append(text)
+                    console.print()
+                    tool_response = await stream.get_final_message()
+                # 更新工具检查器的token使用情况
+                record_usage(tool_checker_tokens, "Tool Checker", tool_response.usage)
+
+                tool_checker_response = "".join(tool_checker_parts)  # 工具检查器响应文本
+                if CONTINUATION_EXIT_PHRASE in tool_checker_response:
+                    exit_continuation = True  # 只检查新增的文本，调用方无需再扫描完整的助手响应
+                assistant_response += "\n\n" + tool_checker_response  # 添加工具检查器响应到助手响应
+                if cache_key is not None:
+                    cache_tool_checker_response(cache_key, tool_checker_response)
+            except APIError as e:
+                error_message = f"Error in tool response: {str(e)}"  # 记录工具响应错误
+                panels.append(Panel(error_message, title="Error", style="bold red"))  # 显示错误信息，与token使用情况一起输出
+                assistant_response += f"\n\n{error_message}"  # 添加错误信息到助手响应
+
+    # 更新对话历史
+    for message, ephemeral in zip(current_conversation, ephemeral_flags):
+        append_history(message, ephemeral)
+    append_history({"role": "assistant", "content": assistant_response})  # 添加助手响应
+
+    # 显示token使用情况，与本轮剩余的面板合并为一次输出
+    panels.append(make_token_usage())
+    console.print(Group(*panels))
 
     return assistant_response, exit_continuation  # 返回助手响应和退出标志
 
@@ -1584,8 +2460,7 @@ def reset_code_editor_memory():
     - console.print(): 在控制台打印信息。
     - Panel(): 创建一个格式化的面板，用于显示信息。
     """
-    global code_editor_memory
-    code_editor_memory = []  # 重置代码编辑器记忆
+    code_editor_memory.clear()  # 重置代码编辑器记忆
     console.print(Panel("Code editor memory has been reset.", title="Reset", style="bold green"))  # 显示重置信息
 
 def reset_conversation():
@@ -1598,30 +2473,54 @@ def reset_conversation():
     - reset_code_editor_memory(): 重置代码编辑器记忆。
     - display_token_usage(): 显示token使用情况。
     """
-    global conversation_history, main_model_tokens, tool_checker_tokens, code_editor_tokens, code_execution_tokens, file_contents, code_editor_files
-    conversation_history = []  # 重置对话历史
-    main_model_tokens = {'input': 0, 'output': 0}  # 重置主模型token
-    tool_checker_tokens = {'input': 0, 'output': 0}  # 重置工具检查器token
-    code_editor_tokens = {'input': 0, 'output': 0}  # 重置代码编辑器token
-    code_execution_tokens = {'input': 0, 'output': 0}  # 重置代码执行token
-    file_contents = {}  # 重置文件内容
-    code_editor_files = set()  # 重置代码编辑器文件集合
+    global conversation_history, main_model_tokens, tool_checker_tokens, code_editor_tokens, code_execution_tokens, token_totals
+    conversation_history.clear()  # 重置对话历史
+    durable_conversation_history.clear()
+    main_model_tokens = TokenStats()  # 重置主模型token
+    tool_checker_tokens = TokenStats()  # 重置工具检查器token
+    code_editor_tokens = TokenStats()  # 重置代码编辑器token
+    code_execution_tokens = TokenStats()  # 重置代码执行token
+    token_totals = TokenStats()  # 重置token总计
+    file_contents.clear()  # 重置文件内容
+    _truncated_files.clear()
+    _file_contents_cache['size'] = 0
+    _file_contents_cache['dirty'] = True  # 文件内容缓存需要重建
+    code_editor_files.clear()  # 重置代码编辑器文件集合，原地清空而不是重新分配
+    _tool_checker_cache.clear()  # 重置工具检查器响应缓存
     reset_code_editor_memory()  # 重置代码编辑器记忆
     console.print(Panel("Conversation history, token counts, file contents, code editor memory, and code editor files have been reset.", title="Reset", style="bold green"))  # 显示重置信息
-    display_token_usage()  # 显示token使用情况
+    display_token_usage(force=True)  # 显示token使用情况
 
-def display_token_usage():
+def display_token_usage(force=False):
     """
     显示token使用情况的函数。
 
+    参数:
+    force (bool): 为True时总是显示完整表格。
+
     调用的外部函数:
-    - Table(): 创建一个表格对象，用于格式化显示数据。
-    - Panel(): 创建一个格式化的面板，用于显示信息。
+    - make_token_usage(): 生成token使用情况的可渲染对象。
     - console.print(): 在控制台打印信息。
     """
-    from rich.table import Table
-    from rich.panel import Panel
-    from rich.box import ROUNDED
+    console.print(make_token_usage(force))
+
+def make_token_usage(force=False):
+    """
+    生成token使用情况的可渲染对象，调用方可以把它和其他输出合并为一次console.print。
+    每TOKEN_DISPLAY_EVERY轮才生成完整表格，其余轮次只生成一行总计，减少自动模式下的终端渲染开销。
+
+    参数:
+    force (bool): 为True时总是生成完整表格。
+
+    返回:
+    Table或Text: token使用情况表格或一行总计。
+
+    调用的外部函数:
+    - Table(): 创建一个表格对象，用于格式化显示数据。
+    """
+    if not force and next(_token_display_turns) % TOKEN_DISPLAY_EVERY:
+        grand_total = token_totals.input + token_totals.output + token_totals.cache_creation + token_totals.cache_read
+        return Text(f"Tokens: {grand_total:,} | Cost: ${token_totals.cost:.3f}", style="dim")
 
     table = Table(box=ROUNDED)  # 创建表格
     table.add_column("Model", style="cyan")  # 添加模型列
@@ -1633,43 +2532,15 @@ def display_token_usage():
     table.add_column(f"% of Context ({MAX_CONTEXT_TOKENS:,})", style="yellow")  # 添加上下文百分比列
     table.add_column("Cost ($)", style="red")  # 添加成本列
 
-    model_costs = {
-        "Main Model": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": True},
-        "Tool Checker": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": False},
-        "Code Editor": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": True},
-        "Code Execution": {"input": 2.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30, "has_context": False}
-    }
-
-    total_input = 0  # 初始化总输入
-    total_output = 0  # 初始化总输出
-    total_cache_write = 0  # 初始化总缓存写入
-    total_cache_read = 0  # 初始化总缓存读取
-    total_cost = 0  # 初始化总成本
     total_context_tokens = 0  # 初始化总上下文token
 
     for model, tokens in [("Main Model", main_model_tokens),
                           ("Tool Checker", tool_checker_tokens),
                           ("Code Editor", code_editor_tokens),
                           ("Code Execution", code_execution_tokens)]:
-        input_tokens = tokens['input']  # 获取输入token
-        output_tokens = tokens['output']  # 获取输出token
-        cache_write_tokens = tokens.get('cache_creation', 0)  # 获取缓存写入token
-        cache_read_tokens = tokens.get('cache_read', 0)  # 获取缓存读取token
-        total_tokens = input_tokens + output_tokens + cache_write_tokens + cache_read_tokens  # 计算总token
-
-        total_input += input_tokens  # 累加总输入
-        total_output += output_tokens  # 累加总输出
-        total_cache_write += cache_write_tokens  # 累加总缓存写入
-        total_cache_read += cache_read_tokens  # 累加总缓存读取
-
-        input_cost = (input_tokens / 1_000_000) * model_costs[model]["input"]  # 计算输入成本
-        output_cost = (output_tokens / 1_000_000) * model_costs[model]["output"]  # 计算输出成本
-        cache_write_cost = (cache_write_tokens / 1_000_000) * model_costs[model]["cache_write"]  # 计算缓存写入成本
-        cache_read_cost = (cache_read_tokens / 1_000_000) * model_costs[model]["cache_read"]  # 计算缓存读取成本
-        model_cost = input_cost + output_cost + cache_write_cost + cache_read_cost  # 计算模型总成本
-        total_cost += model_cost  # 累加总成本
-
-        if model_costs[model]["has_context"]:
+        total_tokens = tokens.input + tokens.output + tokens.cache_creation + tokens.cache_read  # 计算总token
+
+        if MODEL_COSTS[model]["has_context"]:
             total_context_tokens += total_tokens  # 累加上下文token
             percentage = (total_tokens / MAX_CONTEXT_TOKENS) * 100  # 计算上下文百分比
         else:
@@ -1677,31 +2548,145 @@ def display_token_usage():
 
         table.add_row(
             model,
-            f"{input_tokens:,}",  # 添加输入token数
-            f"{output_tokens:,}",  # 添加输出token数
-            f"{cache_write_tokens:,}",  # 添加缓存写入token数
-            f"{cache_read_tokens:,}",  # 添加缓存读取token数
+            f"{tokens.input:,}",  # 添加输入token数
+            f"{tokens.output:,}",  # 添加输出token数
+            f"{tokens.cache_creation:,}",  # 添加缓存写入token数
+            f"{tokens.cache_read:,}",  # 添加缓存读取token数
             f"{total_tokens:,}",  # 添加总token数
-            f"{percentage:.2f}%" if model_costs[model]["has_context"] else "Doesn't save context",  # 添加上下文百分比
-            f"${model_cost:.3f}"  # 添加成本
+            f"{percentage:.2f}%" if MODEL_COSTS[model]["has_context"] else "Doesn't save context",  # 添加上下文百分比
+            f"${tokens.cost:.3f}"  # 添加成本
         )
 
-    grand_total = total_input + total_output + total_cache_write + total_cache_read  # 计算总计
+    # 总计在record_usage()中随每次API调用累加
+    grand_total = token_totals.input + token_totals.output + token_totals.cache_creation + token_totals.cache_read  # 计算总计
     total_percentage = (total_context_tokens / MAX_CONTEXT_TOKENS) * 100  # 计算总上下文百分比
 
     table.add_row(
         "Total",
-        f"{total_input:,}",  # 添加总输入
-        f"{total_output:,}",  # 添加总输出
-        f"{total_cache_write:,}",  # 添加总缓存写入
-        f"{total_cache_read:,}",  # 添加总缓存读取
+        f"{token_totals.input:,}",  # 添加总输入
+        f"{token_totals.output:,}",  # 添加总输出
+        f"{token_totals.cache_creation:,}",  # 添加总缓存写入
+        f"{token_totals.cache_read:,}",  # 添加总缓存读取
         f"{grand_total:,}",  # 添加总计
         f"{total_percentage:.2f}%",  # 添加总上下文百分比
-        f"${total_cost:.3f}",  # 添加总成本
+        f"${token_totals.cost:.3f}",  # 添加总成本
         style="bold"  # 设置样式为粗体
     )
 
-    console.print(table)  # 打印表格
+    return table
+
+# main及命令处理函数中使用的静态面板，在模块加载时创建一次并重复使用
+_PANEL_WELCOME = Panel("Welcome to the Claude-3-Sonnet Engineer Chat with Multi-Agent and Image Support!", title="Welcome", style="bold green")
+_PANEL_GOODBYE = Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green")
+_PANEL_SAVE_CANCELLED = Panel("Chat save cancelled.", title="Save Cancelled", style="yellow")
+_PANEL_LOAD_FAILED = Panel("Failed to load chat. Please check the file and try again.", title="Load Error", style="bold red")
+_PANEL_INVALID_FILE_PATH = Panel("Invalid file path. Please try again.", title="Error", style="bold red")
+_PANEL_INVALID_IMAGE_PATH = Panel("Invalid image path. Please try again.", title="Error", style="bold red")
+_PANEL_AUTOMODE_HINT = Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow")
+_PANEL_AUTOMODE_COMPLETED = Panel("Automode completed.", title_align="left", title="Automode", style="green")
+_PANEL_AUTOMODE_MAX_ITERATIONS = Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red")
+_PANEL_AUTOMODE_INTERRUPTED = Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red")
+_PANEL_AUTOMODE_EXIT = Panel("Exited automode. Returning to regular chat.", style="green")
+
+async def handle_reset_command():
+    """
+    处理reset命令：重置对话，重置所有对话参数。
+    """
+    reset_conversation()
+
+async def handle_save_chat_command():
+    """
+    处理save chat命令：选择格式后保存聊天记录。
+    """
+    format_choice = await get_format_choice()  # 获取保存格式，Markdown或JSON
+    if format_choice is None:
+        console.print(_PANEL_SAVE_CANCELLED)  # 保存取消信息
+        return
+    filename = await asyncio.to_thread(save_chat, format=format_choice)  # 在线程池中保存聊天记录，不阻塞事件循环
+    console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))  # 保存成功信息
+
+async def handle_load_command():
+    """
+    处理load命令：从JSON文件加载聊天记录。
+    """
+    load_path = (await get_user_input("Drag and drop your JSON file here, then press enter: ")).strip().replace("'", "")  # 获取加载路径
+
+    if os.path.isfile(load_path):
+        if await asyncio.to_thread(load_chat, load_path):  # 在线程池中加载聊天记录
+            console.print(Panel(f"Chat loaded from {load_path}", title="Chat Loaded", style="bold green"))  # 加载成功信息
+        else:
+            console.print(_PANEL_LOAD_FAILED)  # 加载失败信息
+    else:
+        console.print(_PANEL_INVALID_FILE_PATH)  # 文件路径无效信息
+
+async def handle_image_command():
+    """
+    处理image命令：获取图像路径和提示后与Claude对话。
+    """
+    image_path = (await get_user_input("Drag and drop your image here, then press enter: ")).strip().replace("'", "")  # 获取图像路径
+
+    if os.path.isfile(image_path):
+        user_input = await get_user_input("You (prompt for image): ")  # 获取用户输入
+        await chat_with_claude(user_input, image_path)  # 处理图像
+    else:
+        console.print(_PANEL_INVALID_IMAGE_PATH)  # 图像路径无效信息
+
+async def handle_automode_command(user_input):
+    """
+    处理automode命令：以指定的迭代次数进入自动模式。
+
+    参数:
+    user_input (str): 用户输入的命令，如"automode 10"。
+    """
+    global automode
+    try:
+        parts = user_input.split()  # 分割用户输入
+        if len(parts) > 1 and parts[1].isdigit():
+            max_iterations = int(parts[1])  # 获取最大迭代次数
+        else:
+            max_iterations = MAX_CONTINUATION_ITERATIONS  # 默认最大迭代次数
+
+        automode = True  # 设置自动模式为真
+        console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))  # 进入自动模式信息
+        console.print(_PANEL_AUTOMODE_HINT)  # 自动模式退出提示
+        user_input = await get_user_input()  # 获取用户输入
+
+        iteration_count = 0  # 初始化迭代计数
+        try:
+            while automode and iteration_count < max_iterations:
+                _, exit_continuation = await chat_with_claude(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)  # 进行对话
+
+                if exit_continuation:
+                    console.print(_PANEL_AUTOMODE_COMPLETED)  # 自动模式完成信息
+                    automode = False  # 设置自动模式为假
+                else:
+                    console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))  # 继续迭代信息
+                    user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."  # 提示继续
+                iteration_count += 1  # 增加迭代计数
+
+                if iteration_count >= max_iterations:
+                    console.print(_PANEL_AUTOMODE_MAX_ITERATIONS)  # 达到最大迭代次数信息
+                    automode = False  # 设置自动模式为假
+        except KeyboardInterrupt:
+            console.print(_PANEL_AUTOMODE_INTERRUPTED)  # 用户中断自动模式信息
+            automode = False  # 设置自动模式为假
+            if conversation_history and conversation_history[-1]["role"] == "user":
+                append_history({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})  # 添加助手响应
+    except KeyboardInterrupt:
+        console.print(_PANEL_AUTOMODE_INTERRUPTED)  # 用户中断自动模式信息
+        automode = False  # 设置自动模式为假
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            append_history({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})  # 添加助手响应
+
+    console.print(_PANEL_AUTOMODE_EXIT)  # 退出自动模式信息
+
+# 交互命令到处理函数的映射，命令在查找前统一转换为小写；automode带参数，按前缀单独匹配
+COMMAND_HANDLERS = {
+    "reset": handle_reset_command,
+    "save chat": handle_save_chat_command,
+    "load": handle_load_command,
+    "image": handle_image_command,
+}
 
 async def main():
     """
@@ -1711,14 +2696,11 @@ async def main():
     - console.print(): 在控制台打印信息。
     - Panel(): 创建一个格式化的面板，用于显示信息。
     - get_user_input(): 异步获取用户输入。
-    - reset_conversation(): 重置对话历史和相关状态。
-    - get_format_choice(): 异步获取保存格式选择。
-    - save_chat(): 保存聊天记录。
-    - load_chat(): 加载聊天记录。
+    - COMMAND_HANDLERS中对应命令的处理函数。
+    - handle_automode_command(): 处理automode命令。
     - chat_with_claude(): 与Claude进行对话。
     """
-    global automode, conversation_history
-    console.print(Panel("Welcome to the Claude-3-Sonnet Engineer Chat with Multi-Agent and Image Support!", title="Welcome", style="bold green"))  # 欢迎信息
+    console.print(_PANEL_WELCOME)  # 欢迎信息
     console.print("Type 'exit' to end the conversation.")  # 退出提示
     console.print("Type 'image' to include an image in your message.")  # 图像提示
     console.print("Type 'automode [number]' to enter Autonomous mode with a specific number of iterations.")  # 自动模式提示
@@ -1729,88 +2711,36 @@ async def main():
 
     while True:
         user_input = await get_user_input()  # 获取用户输入
+        command = user_input.strip().lower()  # 每轮只转换一次小写
 
-        if user_input.lower() == 'exit':
-            console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))  # 退出信息
+        if command == 'exit':
+            console.print(_PANEL_GOODBYE)  # 退出信息
             break
 
-        if user_input.lower() == 'reset':
-            reset_conversation()  # 重置对话，重置所有对话参数
-            continue
-
-        if user_input.lower() == 'save chat':
-            format_choice = await get_format_choice()  # 获取保存格式，Markdown或JSON
-            if format_choice is None:
-                console.print(Panel("Chat save cancelled.", title="Save Cancelled", style="yellow"))  # 保存取消信息
-                continue
-            filename = save_chat(format=format_choice)  # 保存聊天记录
-            console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))  # 保存成功信息
-            continue
-
-        if user_input.lower() == 'load':
-            load_path = (await get_user_input("Drag and drop your JSON file here, then press enter: ")).strip().replace("'", "")  # 获取加载路径
-
-            if os.path.isfile(load_path):
-                if load_chat(load_path):  # 加载聊天记录
-                    console.print(Panel(f"Chat loaded from {load_path}", title="Chat Loaded", style="bold green"))  # 加载成功信息
-                else:
-                    console.print(Panel("Failed to load chat. Please check the file and try again.", title="Load Error", style="bold red"))  # 加载失败信息
-            else:
-                console.print(Panel("Invalid file path. Please try again.", title="Error", style="bold red"))  # 文件路径无效信息
-            continue
+        handler = COMMAND_HANDLERS.get(command)
+        if handler is not None:
+            await handler()
+        elif command.startswith('automode'):
+            await handle_automode_command(user_input)
+        else:
+            await chat_with_claude(user_input)  # 进行对话
 
-        if user_input.lower() == 'image':
-            image_path = (await get_user_input("Drag and drop your image here, then press enter: ")).strip().replace("'", "")  # 获取图像路径
+async def run():
+    """
+    运行主函数，并在退出时关闭Anthropic客户端和Tavily HTTP客户端的连接池。
 
-            if os.path.isfile(image_path):
-                user_input = await get_user_input("You (prompt for image): ")  # 获取用户输入
-                response, _ = await chat_with_claude(user_input, image_path)  # 处理图像
-            else:
-                console.print(Panel("Invalid image path. Please try again.", title="Error", style="bold red"))  # 图像路径无效信息
-                continue
-        elif user_input.lower().startswith('automode'):
-            try:
-                parts = user_input.split()  # 分割用户输入
-                if len(parts) > 1 and parts[1].isdigit():
-                    max_iterations = int(parts[1])  # 获取最大迭代次数
-                else:
-                    max_iterations = MAX_CONTINUATION_ITERATIONS  # 默认最大迭代次数
-
-                automode = True  # 设置自动模式为真
-                console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))  # 进入自动模式信息
-                console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))  # 自动模式退出提示
-                user_input = await get_user_input()  # 获取用户输入
-
-                iteration_count = 0  # 初始化迭代计数
-                try:
-                    while automode and iteration_count < max_iterations:
-                        response, exit_continuation = await chat_with_claude(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)  # 进行对话
-
-                        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
-                            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))  # 自动模式完成信息
-                            automode = False  # 设置自动模式为假
-                        else:
-                            console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))  # 继续迭代信息
-                            user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."  # 提示继续
-                        iteration_count += 1  # 增加迭代计数
-
-                        if iteration_count >= max_iterations:
-                            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))  # 达到最大迭代次数信息
-                            automode = False  # 设置自动模式为假
-                except KeyboardInterrupt:
-                    console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))  # 用户中断自动模式信息
-                    automode = False  # 设置自动模式为假
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})  # 添加助手响应
-            except KeyboardInterrupt:
-                console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))  # 用户中断自动模式信息
-                automode = False  # 设置自动模式为假
-                if conversation_history and conversation_history[-1]["role"] == "user":
-                    conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})  # 添加助手响应
-
-            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))  # 退出自动模式信息
-        else:
-            response, _ = await chat_with_claude(user_input)  # 进行对话
+    调用的外部函数:
+    - main(): 主函数。
+    """
+    try:
+        async with client:
+            await main()
+    finally:
+        if _tavily_http is not None:
+            await _tavily_http.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(main())  # 运行主函数
+    if uvloop is not None:
+        uvloop.run(run())  # 使用uvloop事件循环运行主函数
+    else:
+        asyncio.run(run())  # 运行主函数
@@ -1,3 +1,5 @@
+import asyncio
+
 def read_file(path: str) -> str:
     """
     读取指定路径的文件内容并返回。
@@ -20,3 +22,24 @@ def write_file(path: str, content: str) -> None:
     """
     with open(path, 'w', encoding='utf-8') as file:
         file.write(content)
+
+async def read_file_async(path: str) -> str:
+    """
+    在线程池中读取指定路径的文件内容并返回，不阻塞事件循环。
+    参数:
+    path (str): 文件的路径。
+    返回:
+    str: 文件的内容。
+    """
+    return await asyncio.to_thread(read_file, path)
+
+async def write_file_async(path: str, content: str) -> None:
+    """
+    在线程池中将内容写入指定路径的文件，不阻塞事件循环。
+    参数:
+    path (str): 文件的路径。
+    content (str): 要写入文件的内容。
+    返回:
+    None
+    """
+    await asyncio.to_thread(write_file, path, content)